@@ -1,18 +1,20 @@
 from __future__ import annotations
+import contextlib
 import copy
 import json
 import logging
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile, join
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 
 import accelerate
 import torch
 import torch.nn as nn
 import transformers
+from accelerate import init_empty_weights
 from accelerate.hooks import remove_hook_from_module
-from safetensors.torch import save_file as safe_save
 from tqdm import tqdm
 from transformers import AutoConfig, AutoModelForCausalLM, PretrainedConfig, PreTrainedModel
 from transformers.modeling_utils import no_init_weights, shard_checkpoint
@@ -24,16 +26,23 @@ from ..quantization.config import (FORMAT, FORMAT_FIELD_JSON, META_FIELD_QUANTIZ
                                    MIN_VERSION_WITH_V2, QUANTIZE_BLACK_LIST, AutoRoundQuantizeConfig)
 from ..utils.backend import BACKEND
 from ..utils.bitblas import convert_to_bitblas, prepare_model_for_bitblas_load
-from ..utils.data import collate_data
-from ..utils.device import check_cuda
+from ..utils.capture_cache import CaptureCache
+from ..utils.checkpoint import QuantizeCheckpoint
+from ..utils.data import collate_data, pack_data
+from ..utils.device import check_cuda, get_peak_rss, reset_peak_rss
+from ..utils.disk_cache import DiskCache
 from ..utils.importer import select_quant_linear
 from ..utils.marlin import (_validate_marlin_compatibility,
                             _validate_marlin_device_support, prepare_model_for_marlin_load)
-from ..utils.model import (auto_dtype_from_config, check_to_quantized, convert_gptq_v1_to_v2_format,
-                           convert_gptq_v2_to_v1_format, find_layers, get_checkpoints, get_device,
-                           get_module_by_name_prefix, get_module_by_name_suffix, get_moe_layer_modules,
-                           gptqmodel_post_init, make_quant, move_to, nested_move_to, pack_model,
-                           simple_dispatch_model, verify_model_hash, verify_sharded_model_hashes)
+from ..utils.model import (auto_dtype_from_config, check_to_quantized, find_layers, get_checkpoints, get_device,
+                           get_module_by_name_prefix, get_module_by_name_suffix, get_moe_block_name,
+                           get_moe_layer_modules, gptq_v1_qzeros_transform, gptq_v2_qzeros_transform,
+                           gptqmodel_post_init, load_checkpoint_with_transform, make_quant, move_to, nested_move_to,
+                           pack_model, select_quant_linear_with_pack, simple_dispatch_model, verify_model_hash,
+                           verify_sharded_model_hashes)
+from ..utils.prefetch import BatchPrefetcher
+from ..utils.stream import LayerStreamer, ShardWriter, StagingBuffer, write_safetensors
+from ..utils.timer import StageTimer
 from ..version import __version__
 from ._const import CPU, CUDA_0, DEVICE, SUPPORTED_MODELS
 
@@ -46,6 +55,10 @@ logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
 
+class StopForward(Exception):
+    """Raised by a forward hook to skip the rest of a layer forward whose output is not needed."""
+
+
 class BaseGPTQModel(nn.Module):
     # these modules are non-repeating and at the root level
     # does not include the node which holds all the repeating layers
@@ -95,6 +108,16 @@ class BaseGPTQModel(nn.Module):
         # compat: state to assist in checkpoint_format gptq(v1) to gptq_v2 conversion
         self.qlinear_kernel = qlinear_kernel
 
+        # stage timings of the last quantize(), continued by pack()
+        self.stage_timer = None
+
+        # set by from_pretrained(stream_save_dir=...): layers are read, quantized, packed and written one at a time
+        self.layer_streamer = None
+        self.stream_save_dir = None
+        self.stream_max_shard_size = None
+        # set by quantize(pipeline_save_dir=...): layers were packed and written while quantizing
+        self.pipeline_save_dir = None
+
     @property
     def quantized(self):
         return self._quantized
@@ -107,6 +130,9 @@ class BaseGPTQModel(nn.Module):
             self,
             calibration_dataset: List[Dict[str, Union[List[int], torch.LongTensor]]],
             batch_size: int = 1,
+            batch_tokens: Optional[int] = None,
+            pack: bool = False,
+            pack_max_tokens: int = 2048,
     ):
         def _convert_tensor_to_list(tensor):
             if isinstance(tensor, torch.Tensor):
@@ -142,10 +168,58 @@ class BaseGPTQModel(nn.Module):
         if pad_token_id is None:
             raise ValueError("Calibration data requires model's `pad_token_id` or `eos_token_id` to be set: actual = `None`.")
 
-        new_calibration_dataset_batched = [
-            collate_data(new_calibration_dataset[start: start + batch_size], pad_token_id)
-            for start in range(0, len(new_calibration_dataset), batch_size)
-        ]
+        if batch_tokens:
+            # group samples of similar length, padded (or packed) to at most `batch_tokens` tokens per batch
+            batches = []
+            batch = []
+            batch_rows = 0
+            batch_len = 0
+            for example in sorted(new_calibration_dataset, key=lambda e: len(e["input_ids"][0]), reverse=True):
+                rows = len(example["input_ids"])
+                length = rows * len(example["input_ids"][0])
+                if pack:
+                    size = batch_len + length
+                else:
+                    # sorted longest first, the first sample of a batch sets its padded length
+                    size = (batch_rows + rows) * len(batch[0]["input_ids"][0]) if batch else length
+                if batch and size > batch_tokens:
+                    batches.append(batch)
+                    batch = []
+                    batch_rows = 0
+                    batch_len = 0
+                batch.append(example)
+                batch_rows += rows
+                batch_len += length
+            if batch:
+                batches.append(batch)
+        else:
+            batches = [
+                new_calibration_dataset[start: start + batch_size]
+                for start in range(0, len(new_calibration_dataset), batch_size)
+            ]
+
+        if pack:
+            # the packed mask is dense [T, T], keep every packed sequence within a modest token budget and
+            # never beyond the model's context length
+            max_tokens = min(pack_max_tokens, getattr(self.model, "seqlen", None) or pack_max_tokens)
+            packs = []
+            for batch in batches:
+                pack_batch = []
+                pack_tokens = 0
+                for example in batch:
+                    tokens = sum(sum(mask) for mask in example["attention_mask"])
+                    if pack_batch and pack_tokens + tokens > max_tokens:
+                        packs.append(pack_batch)
+                        pack_batch = []
+                        pack_tokens = 0
+                    pack_batch.append(example)
+                    pack_tokens += tokens
+                if pack_batch:
+                    packs.append(pack_batch)
+            batches = packs
+            return [pack_data(batch, self.model.dtype) for batch in batches]
+
+        new_calibration_dataset_batched = [collate_data(batch, pad_token_id) for batch in batches]
 
         for new_example in new_calibration_dataset_batched:
             del new_example["labels"]
@@ -157,18 +231,233 @@ class BaseGPTQModel(nn.Module):
             calibration_dataset: List[Dict[str, Union[List[int], torch.LongTensor]]],
             batch_size: int = 1,
             calibration_enable_gpu_cache: bool = True,
+            # solve GPTQ.fasterquant blocks with precomputed group params and contiguous updates instead of the
+            # per-column loop, bit identical to it
+            vectorized_solver: bool = False,
+            # accumulate Hessians this many tokens at a time to bound memory on long sequences
+            hessian_chunk_size: Optional[int] = None,
+            # persist quantizers, quant_log and next layer inputs here after every layer
+            checkpoint_dir: Optional[str] = None,
+            # skip the layers finished in this checkpoint dir and continue checkpointing to it
+            resume_from: Optional[str] = None,
+            # number of modules of a subset quantized concurrently
+            quantize_workers: int = 1,
+            # spread the modules of a subset over these devices, modules sharing a Hessian stay together
+            quantize_devices: Optional[List[Union[str, torch.device]]] = None,
+            # append every quant_log entry, including per-layer stage timings, to this file as json lines
+            stats_file: Optional[str] = None,
+            # called with every quant_log entry as soon as it is produced
+            stats_callback: Optional[Callable[[Dict], None]] = None,
+            # spill cached layer inputs/outputs, attention masks and position ids to memory-mapped files here
+            calibration_cache_dir: Optional[str] = None,
+            # host memory the cached tensors may keep resident before spilling, bytes or a "10GB" style string
+            calibration_cache_max_memory: Union[int, str] = 0,
+            # batch samples of similar length up to this many tokens per batch (padding included) instead
+            # of `batch_size` samples in dataset order, padding tokens are left out of the Hessians
+            calibration_batch_tokens: Optional[int] = None,
+            # stop each subset capture forward once every module of the subset has seen its input, by raising from
+            # its hooks. The Hessians are unchanged, but the rest of the layer forward is skipped, so leave it off for
+            # layers whose forward has side effects after the quantized modules
+            truncate_subset_forward: bool = False,
+            # pack the samples of each batch into one sequence with per-sample causal attention instead of
+            # padding them, needs a model that accepts 4D attention masks. The mask is dense, so its memory
+            # grows with the square of the packed length and attention still runs over the masked cross-sample
+            # blocks
+            calibration_pack_samples: bool = False,
+            # batches are split so every packed sequence holds at most this many tokens (and never more than the
+            # model's context length), a longer sample is packed on its own
+            calibration_pack_max_tokens: int = 2048,
+            # quantize every layer against the inputs of the unquantized model instead of the outputs of the
+            # already quantized layers before it, so `quantize_workers` layers (spread round-robin over
+            # `quantize_devices`) are quantized at once. Faster on many devices, but errors of earlier layers
+            # are no longer compensated by later ones, which costs some accuracy; keeps every layer's inputs cached
+            fp_layer_inputs: bool = False,
+            # save the captured inputs of the first layer here and reuse them in later runs on the same base
+            # weights, calibration data and batching options, skipping dataset preparation and the capture forward
+            calibration_capture_cache_dir: Optional[str] = None,
+            # feed moe experts by running only the sparse moe block on its captured inputs, so every expert
+            # sees just the tokens routed to it, instead of replaying the whole layer for every expert subset.
+            # Turn it on for moe models where replaying attention per expert subset dominates quantization time.
+            # Without padding the Hessians are the same, with padding the padding tokens no longer reach the experts
+            moe_routed_capture: bool = False,
+            # pack every layer on a background worker as soon as it is quantized and write it to safetensors
+            # shards in this dir, overlapping packing and disk writes with the next layer. The model is saved
+            # once quantize() returns, pack() only finishes it
+            pipeline_save_dir: Optional[str] = None,
+            # largest shard written to `pipeline_save_dir`
+            pipeline_max_shard_size: Optional[str] = "4GB",
     ):
         if isinstance(self.quantize_config, AutoRoundQuantizeConfig):
-            return self._quantize(calibration_dataset, batch_size, calibration_enable_gpu_cache)
+            return self._quantize(
+                calibration_dataset,
+                batch_size,
+                calibration_enable_gpu_cache,
+                vectorized_solver,
+                hessian_chunk_size,
+                checkpoint_dir,
+                resume_from,
+                quantize_workers,
+                quantize_devices,
+                stats_file,
+                stats_callback,
+                calibration_cache_dir,
+                calibration_cache_max_memory,
+                calibration_batch_tokens,
+                truncate_subset_forward,
+                calibration_pack_samples,
+                calibration_pack_max_tokens,
+                fp_layer_inputs,
+                calibration_capture_cache_dir,
+                moe_routed_capture,
+                pipeline_save_dir,
+                pipeline_max_shard_size,
+            )
         else:
             with torch.inference_mode():
-                return self._quantize(calibration_dataset, batch_size, calibration_enable_gpu_cache)
+                return self._quantize(
+                    calibration_dataset,
+                    batch_size,
+                    calibration_enable_gpu_cache,
+                    vectorized_solver,
+                    hessian_chunk_size,
+                    checkpoint_dir,
+                    resume_from,
+                    quantize_workers,
+                    quantize_devices,
+                    stats_file,
+                    stats_callback,
+                    calibration_cache_dir,
+                    calibration_cache_max_memory,
+                    calibration_batch_tokens,
+                    truncate_subset_forward,
+                    calibration_pack_samples,
+                    calibration_pack_max_tokens,
+                    fp_layer_inputs,
+                    calibration_capture_cache_dir,
+                    moe_routed_capture,
+                    pipeline_save_dir,
+                    pipeline_max_shard_size,
+                )
+
+    def quantize_sweep(
+            self,
+            calibration_dataset: List[Dict[str, Union[List[int], torch.LongTensor]]],
+            quantize_configs: List[QuantizeConfig],
+            # per config (or one value for all): feed its layers the outputs of its own quantized layers, as
+            # quantize() does, instead of the full precision inputs whose Hessians all other configs share
+            quantized_inputs: Union[bool, List[bool]] = False,
+            batch_size: int = 1,
+            calibration_enable_gpu_cache: bool = True,
+            vectorized_solver: bool = False,
+            hessian_chunk_size: Optional[int] = None,
+            stats_file: Optional[str] = None,
+            stats_callback: Optional[Callable[[Dict], None]] = None,
+            calibration_cache_dir: Optional[str] = None,
+            calibration_cache_max_memory: Union[int, str] = 0,
+            calibration_batch_tokens: Optional[int] = None,
+            truncate_subset_forward: bool = False,
+            calibration_pack_samples: bool = False,
+            calibration_pack_max_tokens: int = 2048,
+            calibration_capture_cache_dir: Optional[str] = None,
+            moe_routed_capture: bool = False,
+    ) -> List[BaseGPTQModel]:
+        """Quantize a copy of this model with each of `quantize_configs`, returns the packed models in the same order.
+
+        The calibration inputs are captured once. Each config quantizes a copy of one layer at a time, which is packed
+        right away, so the sweep holds the fp model plus the packed layers of every config instead of N fp copies. Every layer of the configs without `quantized_inputs` is quantized
+        against the full precision model: its Hessians are collected by a single forward and solved once per config,
+        so N configs cost about one quantize() plus N-1 solves. Keyword arguments are those of quantize(), stats
+        entries carry the index of their config. This model keeps its full precision weights.
+        """
+        if self.quantized:
+            raise EnvironmentError("quantize_sweep() is called a model that is already quantized")
+
+        if not quantize_configs:
+            raise ValueError("quantize_configs must not be empty.")
+
+        if isinstance(quantized_inputs, bool):
+            quantized_inputs = [quantized_inputs] * len(quantize_configs)
+        if len(quantized_inputs) != len(quantize_configs):
+            raise ValueError(
+                f"quantized_inputs has {len(quantized_inputs)} values for {len(quantize_configs)} quantize configs."
+            )
+
+        for quantize_config in quantize_configs:
+            if isinstance(quantize_config, AutoRoundQuantizeConfig):
+                raise ValueError("AutoRound quantize configs are not supported by quantize_sweep().")
+            if quantize_config.lm_head:
+                raise ValueError("lm_head quantization is currently inference only and not applicable for quantization. Please set `lm_head=False`.")
+            if quantize_config.format == FORMAT.MARLIN:
+                _validate_marlin_compatibility(quantize_config, throwError=True)
+
+        if self.layer_streamer is not None or self.hf_device_map:
+            raise ValueError("quantize_sweep() needs a model loaded without layer streaming or a device_map.")
+
+        forward_pass_use_cache = self.model.config.use_cache
+        with torch.inference_mode():
+            results = self._quantize(
+                calibration_dataset,
+                batch_size,
+                calibration_enable_gpu_cache,
+                vectorized_solver,
+                hessian_chunk_size,
+                stats_file=stats_file,
+                stats_callback=stats_callback,
+                calibration_cache_dir=calibration_cache_dir,
+                calibration_cache_max_memory=calibration_cache_max_memory,
+                calibration_batch_tokens=calibration_batch_tokens,
+                truncate_subset_forward=truncate_subset_forward,
+                calibration_pack_samples=calibration_pack_samples,
+                calibration_pack_max_tokens=calibration_pack_max_tokens,
+                calibration_capture_cache_dir=calibration_capture_cache_dir,
+                moe_routed_capture=moe_routed_capture,
+                sweep_configs=quantize_configs,
+                sweep_quantized_inputs=quantized_inputs,
+            )
+        self.model.config.use_cache = forward_pass_use_cache
+
+        layers = get_module_by_name_prefix(self.model, self.layers_node)
+        models = []
+        for quantize_config, result in zip(quantize_configs, results):
+            _, packed_layers, qlinear_kernel, force_layer_back_to_cpu, device_map, use_cache = result
+            # copy everything but the layers, whose packed versions take the place of the fp ones
+            memo = {id(layer): packed_layer for layer, packed_layer in zip(layers, packed_layers)}
+            model = self.__class__(
+                copy.deepcopy(self.model, memo), quantized=False, quantize_config=quantize_config,
+                qlinear_kernel=qlinear_kernel,
+            )
+            if force_layer_back_to_cpu:
+                model.model.to(CPU)
+            model._finish_pack(device_map, use_cache)
+            models.append(model)
+        return models
 
     def _quantize(
         self,
         calibration_dataset: List[Dict[str, Union[List[int], torch.LongTensor]]],
         batch_size: int = 1,
         calibration_enable_gpu_cache: bool = True,
+        vectorized_solver: bool = False,
+        hessian_chunk_size: Optional[int] = None,
+        checkpoint_dir: Optional[str] = None,
+        resume_from: Optional[str] = None,
+        quantize_workers: int = 1,
+        quantize_devices: Optional[List[Union[str, torch.device]]] = None,
+        stats_file: Optional[str] = None,
+        stats_callback: Optional[Callable[[Dict], None]] = None,
+        calibration_cache_dir: Optional[str] = None,
+        calibration_cache_max_memory: Union[int, str] = 0,
+        calibration_batch_tokens: Optional[int] = None,
+        truncate_subset_forward: bool = False,
+        calibration_pack_samples: bool = False,
+        calibration_pack_max_tokens: int = 2048,
+        fp_layer_inputs: bool = False,
+        calibration_capture_cache_dir: Optional[str] = None,
+        moe_routed_capture: bool = False,
+        pipeline_save_dir: Optional[str] = None,
+        pipeline_max_shard_size: Optional[str] = "4GB",
+        sweep_configs: Optional[List[QuantizeConfig]] = None,
+        sweep_quantized_inputs: Optional[List[bool]] = None,
     ):
         logger.info(f"start quant")
         if self.quantized:
@@ -179,6 +468,20 @@ class BaseGPTQModel(nn.Module):
                 f"Unsupported quantization operation for quant method: {self.quantize_config.quant_method}"
             )
 
+        if hessian_chunk_size is not None and hessian_chunk_size <= 0:
+            raise ValueError(f"hessian_chunk_size must be a positive number of tokens, got {hessian_chunk_size}.")
+
+        if calibration_batch_tokens is not None and calibration_batch_tokens <= 0:
+            raise ValueError(f"calibration_batch_tokens must be a positive number of tokens, got {calibration_batch_tokens}.")
+
+        if calibration_pack_max_tokens <= 0:
+            raise ValueError(
+                f"calibration_pack_max_tokens must be a positive number of tokens, got {calibration_pack_max_tokens}."
+            )
+
+        if quantize_workers < 1:
+            raise ValueError(f"quantize_workers must be at least 1, got {quantize_workers}.")
+
         if self.quantize_config.format == FORMAT.MARLIN:
             _validate_marlin_compatibility(self.quantize_config, throwError=True)
 
@@ -216,7 +519,73 @@ class BaseGPTQModel(nn.Module):
                     remove_hook_from_module(module, recurse=True)
                     accelerate.cpu_offload_with_hook(module, CUDA_0)
 
-        calibration_dataset = self._prepare_dataset_for_quantization(calibration_dataset, batch_size)
+        if isinstance(self.quantize_config, AutoRoundQuantizeConfig) and (checkpoint_dir or resume_from):
+            raise ValueError("checkpoint_dir and resume_from are not supported with AutoRound quantization.")
+
+        if fp_layer_inputs and (checkpoint_dir or resume_from):
+            raise ValueError("checkpoint_dir and resume_from are not supported with fp_layer_inputs.")
+
+        streamer = self.layer_streamer
+        if streamer is not None and pipeline_save_dir is not None:
+            raise ValueError(f"Layer-streamed models are already written to {self.stream_save_dir}, pipeline_save_dir must not be set.")
+
+        # the shards of a previous save in the output dir are deleted while later layers are still read
+        if streamer is not None and os.path.isdir(self.stream_save_dir) and any(
+            os.path.samefile(os.path.dirname(file), self.stream_save_dir) for file in set(streamer.weight_map.values())
+        ):
+            raise ValueError(f"stream_save_dir {self.stream_save_dir} must not be the directory of the streamed checkpoint.")
+
+        if streamer is not None or pipeline_save_dir is not None:
+            if isinstance(self.quantize_config, AutoRoundQuantizeConfig) or checkpoint_dir or resume_from or fp_layer_inputs:
+                raise ValueError(
+                    "Layer streaming and pipeline_save_dir do not support AutoRound, checkpoint_dir, resume_from or fp_layer_inputs."
+                )
+            if self.quantize_config.format not in [FORMAT.GPTQ, FORMAT.GPTQ_V2]:
+                raise ValueError(
+                    f"Layer streaming and pipeline_save_dir only write {FORMAT.GPTQ} and {FORMAT.GPTQ_V2} formats, got {self.quantize_config.format}."
+                )
+
+        if isinstance(self.quantize_config, AutoRoundQuantizeConfig) and calibration_pack_samples:
+            raise ValueError("calibration_pack_samples is not supported with AutoRound quantization.")
+
+        if isinstance(self.quantize_config, AutoRoundQuantizeConfig) and calibration_capture_cache_dir:
+            raise ValueError("calibration_capture_cache_dir is not supported with AutoRound quantization.")
+
+        capture_cache = None
+        if calibration_capture_cache_dir:
+            modules = []
+            for module_name in self.base_modules:
+                module = get_module_by_name_prefix(self.model, module_name)
+                if module is not None:
+                    if streamer is not None:
+                        streamer.materialize(module, f"{module_name}.")
+                    modules.append(module)
+            fingerprint = CaptureCache.compute_fingerprint(
+                self.model,
+                modules,
+                calibration_dataset,
+                {
+                    "batch_size": batch_size,
+                    "calibration_batch_tokens": calibration_batch_tokens,
+                    "calibration_pack_samples": calibration_pack_samples,
+                    "calibration_pack_max_tokens": calibration_pack_max_tokens,
+                    "version": __version__,
+                },
+            )
+            capture_cache = CaptureCache(calibration_capture_cache_dir, fingerprint)
+            if streamer is not None and capture_cache.exists():
+                # no capture forward runs, the non-layer weights are read again when they are written at the end
+                for module in modules:
+                    streamer.free(module)
+
+        if capture_cache is None or not capture_cache.exists():
+            calibration_dataset = self._prepare_dataset_for_quantization(
+                calibration_dataset,
+                batch_size,
+                batch_tokens=calibration_batch_tokens,
+                pack=calibration_pack_samples,
+                pack_max_tokens=calibration_pack_max_tokens,
+            )
 
         if isinstance(self.quantize_config, AutoRoundQuantizeConfig):
             from auto_round import AutoRound
@@ -306,18 +675,92 @@ class BaseGPTQModel(nn.Module):
         forward_pass_use_cache = self.model.config.use_cache
         self.model.config.use_cache = False
 
-        layer_inputs = []
-        attention_masks = []
-        position_ids = []
+        cache = None
+        if calibration_cache_dir:
+            if calibration_enable_gpu_cache:
+                logger.info("calibration_cache_dir is set, caching layer inputs on cpu instead of gpu.")
+                calibration_enable_gpu_cache = False
+            cache = DiskCache(calibration_cache_dir, calibration_cache_max_memory)
+
+        def new_cache_list():
+            return cache.list() if cache is not None else []
+
+        layer_inputs = new_cache_list()
+        attention_masks = new_cache_list()
+        position_ids = new_cache_list()
+        # small per-batch dicts, always kept in memory
         layer_input_kwargs = []
-        layer_outputs = []
 
-        num_batches = len(calibration_dataset)
         layers = get_module_by_name_prefix(self.model, self.layers_node)
 
+        if streamer is not None:
+            # only what the capture forward runs through is read now, a capture cache hit skips that forward
+            if capture_cache is None or not capture_cache.exists():
+                for module_name in self.base_modules:
+                    module = get_module_by_name_prefix(self.model, module_name)
+                    if module is not None:
+                        streamer.materialize(module, f"{module_name}.")
+            streamer.materialize(layers[0], f"{self.layers_node}.0.")
+
+        writer = None
+        if streamer is not None or pipeline_save_dir is not None:
+            QuantLinear = select_quant_linear_with_pack(
+                bits=self.quantize_config.bits,
+                group_size=self.quantize_config.group_size,
+                desc_act=self.quantize_config.desc_act,
+                sym=True,
+                backend=BACKEND.AUTO,
+                format=self.quantize_config.format,
+                pack=True,
+            )
+            if streamer is not None:
+                save_dir, max_shard_size = self.stream_save_dir, self.stream_max_shard_size
+            else:
+                save_dir, max_shard_size = pipeline_save_dir, pipeline_max_shard_size
+            writer = ShardWriter(save_dir, "model", max_shard_size if QuantLinear.SUPPORTED_SHARDS else None)
+
         cur_layer_device = get_device(layers[0])
         data_device = cur_layer_device if calibration_enable_gpu_cache else CPU
 
+        captured = None
+        if capture_cache is not None and capture_cache.exists():
+            captured = capture_cache.load(map_location=data_device)
+            token_masks = captured["token_masks"]
+            batch_samples = captured["batch_samples"]
+        else:
+            # batches with padding leave the padded tokens out of the Hessians, as if every sample ran alone
+            token_masks = [
+                None if batch["attention_mask"].dim() != 2 or batch["attention_mask"].all() else batch["attention_mask"].bool()
+                for batch in calibration_dataset
+            ]
+            # packed batches hold several samples in one row, each starting at position 0
+            batch_samples = [
+                int((batch["position_ids"] == 0).sum()) if calibration_pack_samples else None for batch in calibration_dataset
+            ]
+        num_batches = len(token_masks)
+
+        timer = StageTimer(log_file=stats_file, callback=stats_callback)
+        self.stage_timer = timer
+
+        checkpoint = None
+        if checkpoint_dir or resume_from:
+            checkpoint = QuantizeCheckpoint(checkpoint_dir or resume_from)
+        if resume_from:
+            if not checkpoint.exists():
+                raise ValueError(f"No quantization checkpoint found at {resume_from}.")
+            shared_inputs = checkpoint.load(self.quantize_config, len(layers), num_batches, map_location=data_device)
+            # layer inputs only exist once the first layer is done, otherwise capture them again below
+            if checkpoint.finished_layers > 0:
+                logger.info(f"Resuming quantization after layer {checkpoint.finished_layers} of {len(layers)}")
+                restored_masks, restored_position_ids, layer_input_kwargs = shared_inputs
+                for cache_list, restored in (
+                    (attention_masks, restored_masks),
+                    (position_ids, restored_position_ids),
+                    (layer_inputs, checkpoint.load_inputs(map_location=data_device)),
+                ):
+                    for item in restored:
+                        cache_list.append(item)
+
         def store_input_hook(_, args, kwargs):
             # Positional arguments.
             layer_input = []
@@ -339,132 +782,344 @@ class BaseGPTQModel(nn.Module):
                 if k not in ["hidden_states", "attention_mask", "position_ids"]:
                     one_kwargs[k] = nested_move_to(v, data_device)
             layer_input_kwargs.append(one_kwargs)
-            raise ValueError
+            raise StopForward
 
         force_layer_back_to_cpu = False
-        if get_device(layers[0]) == CPU:
-            layers[0] = layers[0].to(CUDA_0)
-            force_layer_back_to_cpu = True
+        # the first layer's inputs are not restored from a checkpoint
+        start_inputs = not layer_inputs
+        if start_inputs and captured is not None:
+            for cache_list, restored in (
+                (layer_inputs, captured["layer_inputs"]),
+                (attention_masks, captured["attention_masks"]),
+                (position_ids, captured["position_ids"]),
+            ):
+                for item in restored:
+                    cache_list.append(item)
+            layer_input_kwargs = captured["layer_input_kwargs"]
+        del captured
+
+        if not layer_inputs:
+            if get_device(layers[0]) == CPU:
+                layers[0] = timer.move(layers[0], CUDA_0)
+                force_layer_back_to_cpu = True
 
-        ori_outside_layer_module_devices = {}
-        for module_name in self.base_modules:
-            module = get_module_by_name_prefix(self.model, module_name)
+            ori_outside_layer_module_devices = {}
+            for module_name in self.base_modules:
+                module = get_module_by_name_prefix(self.model, module_name)
 
-            if module is None:
-                continue
+                if module is None:
+                    continue
 
-            ori_outside_layer_module_devices[module_name] = get_device(module)
-            if module is not None:
-                move_to(module, cur_layer_device)
+                ori_outside_layer_module_devices[module_name] = get_device(module)
+                if module is not None:
+                    timer.move(module, cur_layer_device)
+
+            # TODO: make this optional, backporting https://github.com/huggingface/optimum/blob/main/optimum/gptq/quantizer.py
+            handle = layers[0].register_forward_pre_hook(store_input_hook, with_kwargs=True)
+            for example in calibration_dataset:
+                for k, v in example.items():
+                    if len(v.shape) == 1:
+                        v = v.unsqueeze(0)
+                    example[k] = timer.move(v, cur_layer_device)
+                timer.add("capture", tokens=example["input_ids"].numel())
+                try:
+                    with timer.stage("capture", cur_layer_device):
+                        self.model(**example)
+                except StopForward:
+                    pass
+            handle.remove()
+
+            timer.move(layers[0], CPU if force_layer_back_to_cpu else cur_layer_device)
+            for module_name in self.base_modules:
+                module = get_module_by_name_prefix(self.model, module_name)
+                if module is not None:
+                    timer.move(module, ori_outside_layer_module_devices[module_name])
+                    if streamer is not None:
+                        # read again when the non-layer weights are written at the end
+                        streamer.free(module)
 
-        # TODO: make this optional, backporting https://github.com/huggingface/optimum/blob/main/optimum/gptq/quantizer.py
-        handle = layers[0].register_forward_pre_hook(store_input_hook, with_kwargs=True)
-        for example in calibration_dataset:
-            for k, v in example.items():
-                if len(v.shape) == 1:
-                    v = v.unsqueeze(0)
-                example[k] = move_to(v, cur_layer_device)
-            try:
-                self.model(**example)
-            except ValueError:
-                pass
-        handle.remove()
+            torch.cuda.empty_cache()
 
-        move_to(layers[0], CPU if force_layer_back_to_cpu else cur_layer_device)
-        for module_name in self.base_modules:
-            module = get_module_by_name_prefix(self.model, module_name)
-            if module is not None:
-                move_to(module, ori_outside_layer_module_devices[module_name])
+            if capture_cache is not None:
+                capture_cache.save(
+                    {
+                        "layer_inputs": layer_inputs,
+                        "attention_masks": attention_masks,
+                        "position_ids": position_ids,
+                        "layer_input_kwargs": layer_input_kwargs,
+                        "token_masks": token_masks,
+                        "batch_samples": batch_samples,
+                    }
+                )
 
-        torch.cuda.empty_cache()
+        if start_inputs and checkpoint is not None:
+            checkpoint.start(
+                self.quantize_config, len(layers), num_batches, attention_masks, position_ids, layer_input_kwargs
+            )
 
-        layer_modules = self.layer_modules
+        def layer_modules_of(quantize_config):
+            layer_modules = self.layer_modules
 
-        if not self.quantize_config.true_sequential:
-            layer_modules = [sum(layer_modules, [])]
+            if not quantize_config.true_sequential:
+                layer_modules = [sum(layer_modules, [])]
 
-        # dynamic expert layer index for model defs
-        if self.dynamic_expert_index is not None:
-            num_experts = getattr(self.model.config, self.dynamic_expert_index)
-            layer_modules = get_moe_layer_modules(layer_modules=self.layer_modules,
-                                                      num_experts=num_experts)
+            # dynamic expert layer index for model defs
+            if self.dynamic_expert_index is not None:
+                num_experts = getattr(self.model.config, self.dynamic_expert_index)
+                layer_modules = get_moe_layer_modules(layer_modules=self.layer_modules,
+                                                          num_experts=num_experts)
+            return layer_modules
+
+        layer_modules = layer_modules_of(self.quantize_config)
+
+        # subsets inside this block are fed by replaying the block alone, see `moe_routed_capture`
+        moe_block = get_moe_block_name(layer_modules) if moe_routed_capture else None
 
         quantizers = {}
 
         # stores all per-layer quant stats such as avg loss and processing time
         quant_log = []
 
-        layer_count = len(layers)
-        layer_pb = tqdm(range(layer_count))
-        for i in layer_pb:
-            layer_pb.set_description(f"Quantizing layer {i + 1} of {layer_count}")
-            layer = layers[i]
-            force_layer_back_to_cpu = False
-            if get_device(layer) == CPU:
-                move_to(layer, CUDA_0)
-                force_layer_back_to_cpu = True
-            cur_layer_device = get_device(layer)
+        def log_stats(stat):
+            quant_log.append(stat)
+            logger.info(stat)
+            timer.emit(stat)
+
+        # layer 0 holds the stages that precede the first layer, nothing to report when resumed
+        capture_stats = timer.flush(0)
+        if capture_stats["stages"]:
+            log_stats(capture_stats)
+
+        if quantize_devices:
+            quantize_devices = [torch.device(d) for d in quantize_devices]
+
+        executor = None
+        num_threads = torch.get_num_threads()
+        if quantize_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=quantize_workers)
+            # split cpu threads between workers so concurrent cpu solves do not oversubscribe cores
+            torch.set_num_threads(max(1, num_threads // quantize_workers))
+
+        def batch_inputs(j, inputs):
+            additional_layer_inputs = {"attention_mask": attention_masks[j]}
+            if position_ids:
+                additional_layer_inputs["position_ids"] = position_ids[j]
+            additional_layer_inputs.update(layer_input_kwargs[j])
+            return list(inputs[j]), additional_layer_inputs
+
+        def layer_batches(inputs, device, timer):
+            """Yield `(layer_input, additional_layer_inputs)` of every batch of `inputs` on `device`."""
+            if device.type == "cuda" and data_device == CPU:
+                # copy the next batches from host memory in the background while this one runs
+                prefetcher = BatchPrefetcher(lambda j: batch_inputs(j, inputs), num_batches, device)
+                yield from prefetcher
+                timer.add("prefetch", seconds=prefetcher.wait_time, bytes=prefetcher.bytes)
+                return
 
+            for j in range(num_batches):
+                layer_input, additional_layer_inputs = batch_inputs(j, inputs)
+                layer_input = [timer.move(inp, device) for inp in layer_input]
+                for k, v in additional_layer_inputs.items():
+                    if isinstance(v, torch.Tensor):
+                        additional_layer_inputs[k] = timer.move(v, device)
+                    else:
+                        additional_layer_inputs[k] = nested_move_to(v, device)
+                yield layer_input, additional_layer_inputs
+
+        def layer_outputs_of(layer, inputs, device, timer):
+            """Run `layer` over every batch of `inputs`, return its outputs cached like `inputs`."""
+            outputs = new_cache_list()
+            for layer_input, additional_layer_inputs in layer_batches(inputs, device, timer):
+                timer.add("output_forward", tokens=layer_input[0].shape[:-1].numel())
+                with torch.no_grad():
+                    with timer.stage("output_forward", device):
+                        layer_output = layer(*layer_input, **additional_layer_inputs)[0]
+                    layer_output = timer.move(layer_output, device if calibration_enable_gpu_cache else CPU)
+                    outputs.append([layer_output])
+            return outputs
+
+        def moe_block_inputs(layer, block, inputs, device, timer):
+            """Capture the inputs of `block`, the sparse moe block of `layer`, for every batch of `inputs`.
+
+            Returns `(args, kwargs, num_samples)` lists. Padding tokens are dropped, the block routes tokens one by one.
+            """
+            block_args = new_cache_list()
+            block_kwargs = []
+            block_samples = []
+            captured = []
+
+            def store_block_input(_, args, kwargs):
+                captured.append((args, kwargs))
+                raise StopForward
+
+            handle = block.register_forward_pre_hook(store_block_input, with_kwargs=True)
+            for j, (layer_input, additional_layer_inputs) in enumerate(layer_batches(inputs, device, timer)):
+                timer.add("forward", tokens=layer_input[0].shape[:-1].numel())
+                try:
+                    with torch.no_grad(), timer.stage("forward", device):
+                        layer(*layer_input, **additional_layer_inputs)
+                except StopForward:
+                    pass
+                args, kwargs = captured.pop()
+                hidden_states = args[0]
+                num_samples = batch_samples[j]
+                if token_masks[j] is not None and hidden_states.shape[:-1] == token_masks[j].shape:
+                    num_samples = hidden_states.shape[0]
+                    hidden_states = hidden_states[token_masks[j].to(hidden_states.device)].unsqueeze(0)
+                block_args.append([move_to(a, data_device) for a in (hidden_states, *args[1:])])
+                block_kwargs.append(nested_move_to(kwargs, data_device))
+                block_samples.append(num_samples)
+            handle.remove()
+            return block_args, block_kwargs, block_samples
+
+        def quantize_layer(i, layer, inputs, cur_layer_device, result_device, timer, executor, devices, log_stats,
+                           layer_pb=None, config=None, results=None):
+            """Quantize every subset of `layer`, feeding it `inputs`, and store the results in `quantizers`.
+
+            A sweep passes the `config` to quantize with and the `results` dict to fill instead.
+            """
+            config = config if config is not None else self.quantize_config
+            results = results if results is not None else quantizers
             full = find_layers(layer)
-            for names in layer_modules:
+            block = dict(layer.named_modules()).get(moe_block) if moe_block is not None else None
+            block_inputs = None
+            for names in layer_modules_of(config):
                 subset = {n: full[n] for n in names if n in full}
+                if block is not None and subset and all(n.startswith(f"{moe_block}.") for n in subset):
+                    # quantizing the block's own modules leaves its inputs unchanged, capture them once per layer
+                    if block_inputs is None:
+                        block_inputs = moe_block_inputs(layer, block, inputs, cur_layer_device, timer)
+                elif block_inputs is not None:
+                    if cache is not None:
+                        block_inputs[0].close()
+                    block_inputs = None
                 gptq = {}
                 for name in subset:
-                    gptq[name] = GPTQ(subset[name])
+                    gptq[name] = GPTQ(subset[name], hessian_chunk_size=hessian_chunk_size)
                     gptq[name].quantizer.configure(
-                        self.quantize_config.bits,
+                        config.bits,
                         perchannel=True,
-                        sym=self.quantize_config.sym,
-                        mse=False,
+                        sym=config.sym,
+                        mse=config.mse,
                     )
 
+                # modules that receive the very same input tensor object in a forward (q/k/v, up/gate)
+                # accumulate one shared Hessian instead of computing identical copies
+                first_inputs = {}
+                # modules of the subset that have seen the current batch
+                fired = set()
+                token_mask = None
+                num_samples = None
+
                 def add_batch(name):
                     def tmp(_, inp, out):
                         # gptq is mutable.
-                        gptq[name].add_batch(inp[0].data, out.data)  # noqa: F821
+                        if gptq[name].nsamples == 0 and gptq[name].hessian_owner is None:  # noqa: F821
+                            for owner, owner_inp in first_inputs.items():
+                                if owner_inp is inp[0]:
+                                    gptq[name].share_hessian(gptq[owner])  # noqa: F821
+                                    break
+                            else:
+                                first_inputs[name] = inp[0]
+                        with timer.stage("hessian", gptq[name].dev):  # noqa: F821
+                            gptq[name].add_batch(inp[0].data, out.data, token_mask, num_samples)  # noqa: F821
+                        if truncate_subset_forward:
+                            fired.add(name)
+                            if len(fired) == len(subset):
+                                raise StopForward
 
                     return tmp
 
                 handles = []
                 for name in subset:
                     handles.append(subset[name].register_forward_hook(add_batch(name)))
-                for j in range(num_batches):
-                    layer_input = []
-                    for k, layer_inp in enumerate(layer_inputs[j]):
-                        layer_input.append(move_to(layer_inp, cur_layer_device))
-
-                    mask = attention_masks[j]
-                    layer_attention_mask = mask if mask is None else move_to(mask, cur_layer_device)
-
-                    additional_layer_inputs = {"attention_mask": layer_attention_mask}
-                    layer_position_ids = (
-                        None if not position_ids else move_to(position_ids[j], cur_layer_device)
+                if block_inputs is not None:
+                    # every expert hook only sees the tokens routed to it
+                    block_args, block_kwargs, block_samples = block_inputs
+                    batches = (
+                        (block, [timer.move(a, cur_layer_device) if isinstance(a, torch.Tensor) else a for a in block_args[j]],
+                         nested_move_to(block_kwargs[j], cur_layer_device), None, block_samples[j])
+                        for j in range(num_batches)
                     )
-                    if layer_position_ids is not None:
-                        additional_layer_inputs["position_ids"] = layer_position_ids
-                    for k, v in layer_input_kwargs[j].items():
-                        additional_layer_inputs[k] = nested_move_to(v, cur_layer_device)
-                    with torch.no_grad():
-                        layer(*layer_input, **additional_layer_inputs)
+                else:
+                    batches = (
+                        (layer, layer_input, additional_layer_inputs, token_masks[j], batch_samples[j])
+                        for j, (layer_input, additional_layer_inputs) in enumerate(layer_batches(inputs, cur_layer_device, timer))
+                    )
+                for module, module_input, module_kwargs, batch_mask, num_samples in batches:
+                    token_mask = None if batch_mask is None else batch_mask.to(cur_layer_device)
+                    timer.add("forward", tokens=module_input[0].shape[:-1].numel())
+                    try:
+                        with torch.no_grad(), timer.stage("forward", cur_layer_device):
+                            module(*module_input, **module_kwargs)
+                    except StopForward:
+                        pass
+                    first_inputs.clear()
+                    fired.clear()
                 for h in handles:
                     h.remove()
 
+                routed_tokens = {}
+                if block_inputs is not None:
+                    for name in subset:
+                        owner = gptq[name].hessian_owner if gptq[name].hessian_owner is not None else gptq[name]
+                        routed_tokens[name] = owner.tokens
+                    idle = [name for name, tokens in routed_tokens.items() if tokens == 0]
+                    if idle:
+                        logger.warning(
+                            f"No calibration tokens were routed to {', '.join(idle)} in layer {i + 1}, their weights are "
+                            f"quantized round-to-nearest. Use more or more diverse calibration data."
+                        )
+
+                def fasterquant(name, device):
+                    # runs on a worker thread when quantize_workers > 1
+                    if device != cur_layer_device:
+                        gptq[name].to(device)  # noqa: F821
+                    with torch.cuda.device(device) if device.type == "cuda" else contextlib.nullcontext():
+                        result = gptq[name].fasterquant(  # noqa: F821
+                            percdamp=config.damp_percent,
+                            group_size=config.group_size,
+                            actorder=config.desc_act,
+                            static_groups=config.static_groups,
+                            vectorized=vectorized_solver,
+                        )
+                    if device != cur_layer_device:
+                        gptq[name].layer.to(cur_layer_device)  # noqa: F821
+                    return result
+
+                module_devices = dict.fromkeys(subset, cur_layer_device)
+                if devices:
+                    # round-robin over Hessian groups so siblings share the Hessian on one device
+                    owners = {}
+                    for name in subset:
+                        owner = gptq[name].hessian_owner if gptq[name].hessian_owner is not None else gptq[name]
+                        owners.setdefault(id(owner), len(owners))
+                        module_devices[name] = devices[owners[id(owner)] % len(devices)]
+
+                futures = {}
+                if executor is not None:
+                    for name in subset:
+                        futures[name] = executor.submit(fasterquant, name, module_devices[name])
+
+                # results are collected in subset order so quantizers and quant_log keep their order
                 for name in subset:
-                    layer_pb.set_description(f"Quantizing {name} in layer {i + 1} of {layer_count}")
+                    if layer_pb is not None:
+                        layer_pb.set_description(f"Quantizing {name} in layer {i + 1} of {layer_count}")
 
                     try:
-                        scale, zero, g_idx, duration, avg_loss = gptq[name].fasterquant(
-                            percdamp=self.quantize_config.damp_percent,
-                            group_size=self.quantize_config.group_size,
-                            actorder=self.quantize_config.desc_act,
-                            static_groups=self.quantize_config.static_groups,
-                        )
+                        if name in futures:
+                            scale, zero, g_idx, duration, avg_loss = futures[name].result()
+                        else:
+                            scale, zero, g_idx, duration, avg_loss = fasterquant(name, module_devices[name])
 
                         stat = {"layer": i + 1, "module": name, "avg_loss": f"{avg_loss:.4f}",
                                 "time": f"{duration:.4f}"}
+                        if name in routed_tokens:
+                            stat["tokens"] = routed_tokens[name]
 
-                        quant_log.append(stat)
-                        logger.info(stat)
+                        log_stats(stat)
+                        for stage, seconds in gptq[name].durations.items():
+                            timer.add(stage, seconds=seconds)
 
                     except torch._C._LinAlgError as e:
                         if "not positive-definite" in str(e).lower():
@@ -473,62 +1128,442 @@ class BaseGPTQModel(nn.Module):
                             )
                         raise e
 
-                    quantizers[f"{self.layers_node}.{i}.{name}"] = (
-                        gptq[name].quantizer.to(CPU if force_layer_back_to_cpu else cur_layer_device),
-                        move_to(scale, CPU if force_layer_back_to_cpu else cur_layer_device),
-                        move_to(zero, CPU if force_layer_back_to_cpu else cur_layer_device),
-                        move_to(g_idx, CPU if force_layer_back_to_cpu else cur_layer_device),
+                    results[f"{self.layers_node}.{i}.{name}"] = (
+                        gptq[name].quantizer.to(result_device),
+                        move_to(scale, result_device),
+                        move_to(zero, result_device),
+                        move_to(g_idx, result_device),
                     )
                     gptq[name].free()
 
-            for j in range(num_batches):
-                layer_input = []
-                for k, layer_inp in enumerate(layer_inputs[j]):
-                    layer_input.append(move_to(layer_inp, cur_layer_device))
-
-                mask = attention_masks[j]
-                layer_attention_mask = mask if mask is None else move_to(mask, cur_layer_device)
-
-                additional_layer_inputs = {"attention_mask": layer_attention_mask}
-                layer_position_ids = None if not position_ids else move_to(position_ids[j], cur_layer_device)
-                if layer_position_ids is not None:
-                    additional_layer_inputs["position_ids"] = layer_position_ids
-                for k, v in layer_input_kwargs[j].items():
-                    additional_layer_inputs[k] = nested_move_to(v, cur_layer_device)
-                with torch.no_grad():
-                    layer_output = move_to(
-                        layer(*layer_input, **additional_layer_inputs)[0],
-                        cur_layer_device if calibration_enable_gpu_cache else CPU,
+            if block_inputs is not None and cache is not None:
+                block_inputs[0].close()
+
+        def collect_hessians(layer, inputs, device, timer, keep_outputs=True):
+            """Accumulate the Hessians of every module of `layer` in one pass, returned with the layer outputs."""
+            full = find_layers(layer)
+            names = [n for n in sum(layer_modules, []) if n in full]
+            gptq = {name: GPTQ(full[name], hessian_chunk_size=hessian_chunk_size) for name in names}
+            first_inputs = {}
+            token_mask = None
+            num_samples = None
+
+            def add_batch(name):
+                def tmp(_, inp, out):
+                    if gptq[name].nsamples == 0 and gptq[name].hessian_owner is None:
+                        for owner, owner_inp in first_inputs.items():
+                            if owner_inp is inp[0]:
+                                gptq[name].share_hessian(gptq[owner])
+                                break
+                        else:
+                            first_inputs[name] = inp[0]
+                    with timer.stage("hessian", device):
+                        gptq[name].add_batch(inp[0].data, out.data, token_mask, num_samples)
+
+                return tmp
+
+            handles = [full[name].register_forward_hook(add_batch(name)) for name in names]
+            outputs = new_cache_list() if keep_outputs else None
+            for j, (layer_input, additional_layer_inputs) in enumerate(layer_batches(inputs, device, timer)):
+                token_mask = None if token_masks[j] is None else token_masks[j].to(device)
+                num_samples = batch_samples[j]
+                timer.add("forward", tokens=layer_input[0].shape[:-1].numel())
+                with torch.no_grad(), timer.stage("forward", device):
+                    layer_output = layer(*layer_input, **additional_layer_inputs)[0]
+                if keep_outputs:
+                    outputs.append([timer.move(layer_output, data_device)])
+                first_inputs.clear()
+            for h in handles:
+                h.remove()
+            return gptq, outputs
+
+        def solve_layer(i, layer, hessians, clone, config, results, result_device, timer, log_stats):
+            """Quantize the modules of `layer` with `config`, using the `hessians` collected on another copy of it."""
+            full = find_layers(layer)
+            gptq = {}
+            owners = {}
+            for name in sum(layer_modules_of(config), []):
+                if name not in hessians:
+                    continue
+                gptq[name] = GPTQ(full[name])
+                gptq[name].quantizer.configure(config.bits, perchannel=True, sym=config.sym, mse=config.mse)
+                # modules that shared a Hessian while collecting share the copy too
+                source = hessians[name].hessian_owner if hessians[name].hessian_owner is not None else hessians[name]
+                if id(source) in owners:
+                    gptq[name].share_hessian(gptq[owners[id(source)]])
+                else:
+                    owners[id(source)] = name
+                    gptq[name].load_hessian(source, clone=clone)
+
+            for name in gptq:
+                scale, zero, g_idx, duration, avg_loss = gptq[name].fasterquant(
+                    percdamp=config.damp_percent,
+                    group_size=config.group_size,
+                    actorder=config.desc_act,
+                    static_groups=config.static_groups,
+                    vectorized=vectorized_solver,
+                )
+                log_stats({"layer": i + 1, "module": name, "avg_loss": f"{avg_loss:.4f}", "time": f"{duration:.4f}"})
+                for stage, seconds in gptq[name].durations.items():
+                    timer.add(stage, seconds=seconds)
+
+                results[f"{self.layers_node}.{i}.{name}"] = (
+                    gptq[name].quantizer.to(result_device),
+                    move_to(scale, result_device),
+                    move_to(zero, result_device),
+                    move_to(g_idx, result_device),
+                )
+                gptq[name].free()
+
+        layer_count = len(layers)
+
+        if fp_layer_inputs:
+            # the inputs of every layer come from the unquantized model, so layers no longer wait on each other
+            all_layer_inputs = [layer_inputs]
+            for i in tqdm(range(layer_count - 1), desc="Capturing full precision layer inputs"):
+                layer = layers[i]
+                layer_device = get_device(layer)
+                cur_layer_device = CUDA_0 if layer_device == CPU else layer_device
+                timer.move(layer, cur_layer_device)
+                all_layer_inputs.append(layer_outputs_of(layer, all_layer_inputs[-1], cur_layer_device, timer))
+                timer.move(layer, layer_device)
+            log_stats(timer.flush(0))
+
+            def quantize_fp_layer(i):
+                layer = layers[i]
+                layer_device = get_device(layer)
+                if quantize_devices:
+                    cur_layer_device = quantize_devices[i % len(quantize_devices)]
+                else:
+                    cur_layer_device = CUDA_0 if layer_device == CPU else layer_device
+                layer_timer = StageTimer()
+                layer_stats = []
+                layer_timer.move(layer, cur_layer_device)
+                with torch.cuda.device(cur_layer_device) if cur_layer_device.type == "cuda" else contextlib.nullcontext():
+                    quantize_layer(i, layer, all_layer_inputs[i], cur_layer_device, layer_device, layer_timer, None,
+                                   None, layer_stats.append)
+                layer_timer.move(layer, layer_device)
+                if cache is not None:
+                    all_layer_inputs[i].close()
+                layer_stats.append(layer_timer.flush(i + 1))
+                return layer_stats
+
+            layer_futures = [executor.submit(quantize_fp_layer, i) for i in range(layer_count)] if executor else []
+            # results are logged in layer order as layers finish
+            for i in tqdm(range(layer_count), desc="Quantizing layers with full precision inputs"):
+                for stat in layer_futures[i].result() if layer_futures else quantize_fp_layer(i):
+                    log_stats(stat)
+            force_layer_back_to_cpu = get_device(layers[-1]) == CPU
+            layer_inputs = all_layer_inputs[-1]
+            del all_layer_inputs
+
+        if sweep_configs is not None:
+            sweep_logs = [[] for _ in sweep_configs]
+            sweep_quantizers = [{} for _ in sweep_configs]
+            # every config quantizes its own copy of a layer, which is packed right away, so besides the fp model
+            # only one fp layer copy per config and the packed layers are held
+            sweep_layers = [[] for _ in sweep_configs]
+            sweep_kernels = [None for _ in sweep_configs]
+            fp_configs = [k for k, quantized in enumerate(sweep_quantized_inputs) if not quantized]
+            # configs fed by their own quantized layers all start from the captured inputs
+            captured_inputs = layer_inputs
+            streams = {k: captured_inputs for k, quantized in enumerate(sweep_quantized_inputs) if quantized}
+
+            def sweep_log_stats(k):
+                def log(stat):
+                    stat["config"] = k
+                    sweep_logs[k].append(stat)
+                    logger.info(stat)
+                    timer.emit(stat)
+
+                return log
+
+            def pack_sweep_layer(i, k, layer, layer_device):
+                """Pack the copy of layer `i` quantized with config `k`, its quantizer results are no longer needed."""
+                prefix = f"{self.layers_node}.{i}."
+                layer_quantizers = {
+                    name[len(prefix):]: sweep_quantizers[k].pop(name)
+                    for name in list(sweep_quantizers[k])
+                    if name.startswith(prefix)
+                }
+                with timer.stage("pack"):
+                    sweep_kernels[k] = pack_model(
+                        model=layer,
+                        quantizers=layer_quantizers,
+                        bits=sweep_configs[k].bits,
+                        group_size=sweep_configs[k].group_size,
+                        backend=BACKEND.AUTO,
+                        desc_act=sweep_configs[k].desc_act,
+                        force_layer_back_to_cpu=layer_device == CPU,
+                        format=sweep_configs[k].format,
+                        low_memory=True,
                     )
-                    layer_outputs.append([layer_output])
+                sweep_layers[k].append(layer)
+
+            for i in tqdm(range(layer_count), desc=f"Quantizing layers for {len(sweep_configs)} configs"):
+                layer_device = get_device(layers[i])
+                cur_layer_device = CUDA_0 if layer_device == CPU else layer_device
+                last_layer = i == layer_count - 1
+
+                if fp_configs:
+                    timer.move(layers[i], cur_layer_device)
+                    hessians, layer_outputs = collect_hessians(layers[i], layer_inputs, cur_layer_device, timer,
+                                                               keep_outputs=not last_layer)
+                    timer.move(layers[i], layer_device)
+                    for n, k in enumerate(fp_configs):
+                        layer = timer.move(copy.deepcopy(layers[i]), cur_layer_device)
+                        # the last config takes the collected Hessians over instead of copying them
+                        solve_layer(i, layer, hessians, n < len(fp_configs) - 1, sweep_configs[k],
+                                    sweep_quantizers[k], layer_device, timer, sweep_log_stats(k))
+                        pack_sweep_layer(i, k, timer.move(layer, layer_device), layer_device)
+                    del hessians
+                    if cache is not None and layer_inputs is not captured_inputs:
+                        layer_inputs.close()
+                    layer_inputs = layer_outputs
+
+                for k in list(streams):
+                    inputs = streams[k]
+                    layer = timer.move(copy.deepcopy(layers[i]), cur_layer_device)
+                    quantize_layer(i, layer, inputs, cur_layer_device, layer_device, timer, None, None,
+                                   sweep_log_stats(k), config=sweep_configs[k], results=sweep_quantizers[k])
+                    streams[k] = None if last_layer else layer_outputs_of(layer, inputs, cur_layer_device, timer)
+                    pack_sweep_layer(i, k, timer.move(layer, layer_device), layer_device)
+                    if cache is not None and inputs is not captured_inputs:
+                        inputs.close()
+
+                log_stats(timer.flush(i + 1))
+                torch.cuda.empty_cache()
+
+            force_layer_back_to_cpu = get_device(layers[-1]) == CPU
+            if cache is not None and layer_inputs is not None and layer_inputs is not captured_inputs:
+                layer_inputs.close()
+            layer_inputs = captured_inputs
+
+        def pack_and_write(i, layer_quantizers, layer_device):
+            """
+            Pack the quantized layer `i` with its `layer_quantizers`, keyed by module name within the layer, and hand
+            its tensors to the writer, returns the stage stats of both.
+            """
+            prefix = f"{self.layers_node}.{i}."
+            layer_timer = StageTimer()
+            with layer_timer.stage("pack"):
+                self.qlinear_kernel = pack_model(
+                    model=layers[i],
+                    quantizers=layer_quantizers,
+                    bits=self.quantize_config.bits,
+                    group_size=self.quantize_config.group_size,
+                    backend=BACKEND.AUTO,
+                    desc_act=self.quantize_config.desc_act,
+                    force_layer_back_to_cpu=layer_device == CPU,
+                    format=self.quantize_config.format,
+                    # quantization of the next layer runs meanwhile, leave its thread limits alone
+                    threads_per_worker=None,
+                    low_memory=True,
+                )
+            with layer_timer.stage("write"):
+                state_dict = layers[i].state_dict()
+                if self.quantize_config.format == FORMAT.GPTQ:
+                    # the layer itself stays in gptq v2, as pack() leaves it, only its written qzeros are converted
+                    transform = gptq_v1_qzeros_transform(
+                        layers[i], quantize_config=self.quantize_config, qlinear_kernel=self.qlinear_kernel
+                    )
+                    state_dict = {k: transform(k, v) for k, v in state_dict.items()}
+                writer.add({prefix + k: v for k, v in state_dict.items()})
+            if streamer is not None:
+                streamer.free(layers[i])
+            return layer_timer.flush(i + 1)
+
+        # a single worker packs and writes one layer while the next one is quantized
+        pack_executor = ThreadPoolExecutor(max_workers=1) if writer is not None else None
+        pack_future = None
 
-            layers[i] = move_to(layer, CPU if force_layer_back_to_cpu else cur_layer_device)
+        layer_pb = tqdm(range(layer_count)) if not fp_layer_inputs and sweep_configs is None else []
+        for i in layer_pb:
+            if checkpoint is not None and i < checkpoint.finished_layers:
+                layer_pb.set_description(f"Restoring layer {i + 1} of {layer_count} from checkpoint")
+                weights, layer_quantizers, layer_quant_log = checkpoint.load_layer(i)
+
+                full = find_layers(layers[i])
+                for name, weight in weights.items():
+                    full[name].weight.data.copy_(weight)
+
+                cur_layer_device = get_device(layers[i])
+                force_layer_back_to_cpu = cur_layer_device == CPU
+                for key, (quantizer, scale, zero, g_idx) in layer_quantizers.items():
+                    quantizers[key] = (
+                        quantizer.to(cur_layer_device),
+                        move_to(scale, cur_layer_device),
+                        move_to(zero, cur_layer_device),
+                        move_to(g_idx, cur_layer_device),
+                    )
+                quant_log.extend(layer_quant_log)
+                continue
+
+            layer_pb.set_description(f"Quantizing layer {i + 1} of {layer_count}")
+            layer = layers[i]
+            if streamer is not None:
+                streamer.materialize(layer, f"{self.layers_node}.{i}.")
+            force_layer_back_to_cpu = False
+            if get_device(layer) == CPU:
+                timer.move(layer, CUDA_0)
+                force_layer_back_to_cpu = True
+            cur_layer_device = get_device(layer)
+
+            quantize_layer(i, layer, layer_inputs, cur_layer_device, CPU if force_layer_back_to_cpu else cur_layer_device,
+                           timer, executor, quantize_devices, log_stats, layer_pb)
+
+            layer_outputs = layer_outputs_of(layer, layer_inputs, cur_layer_device, timer)
+
+            layers[i] = timer.move(layer, CPU if force_layer_back_to_cpu else cur_layer_device)
             del layer
-            del gptq
-            del layer_inputs
-            layer_inputs, layer_outputs = (
-                layer_outputs,
-                [],
-            )  # TODO: is it really OK to cache only the first positional argument?
+            if cache is not None:
+                layer_inputs.close()
+            # TODO: is it really OK to cache only the first positional argument?
+            layer_inputs = layer_outputs
+            del layer_outputs
+
+            log_stats(timer.flush(i + 1))
+
+            if pack_executor is not None:
+                # at most one layer waits to be packed, so only its fp weights are held besides the current layer's
+                if pack_future is not None:
+                    log_stats(pack_future.result())
+                # snapshot on this thread, quantizing the next layer adds to `quantizers` while the worker packs
+                prefix = f"{self.layers_node}.{i}."
+                layer_quantizers = {k[len(prefix):]: v for k, v in quantizers.items() if k.startswith(prefix)}
+                pack_future = pack_executor.submit(
+                    pack_and_write, i, layer_quantizers, CPU if force_layer_back_to_cpu else cur_layer_device
+                )
+
+            if checkpoint is not None:
+                prefix = f"{self.layers_node}.{i}."
+                layer_quantizers = {k: v for k, v in quantizers.items() if k.startswith(prefix)}
+                full = find_layers(layers[i])
+                checkpoint.save_layer(
+                    i,
+                    weights={k[len(prefix):]: full[k[len(prefix):]].weight.data for k in layer_quantizers},
+                    quantizers=layer_quantizers,
+                    quant_log=[stat for stat in quant_log if stat["layer"] == i + 1],
+                    next_layer_inputs=layer_inputs,
+                )
             torch.cuda.empty_cache()
+        if executor is not None:
+            executor.shutdown()
+            torch.set_num_threads(num_threads)
+        if cache is not None:
+            for cache_list in (layer_inputs, attention_masks, position_ids):
+                cache_list.close()
+
+        if pack_executor is not None:
+            if pack_future is not None:
+                log_stats(pack_future.result())
+            pack_executor.shutdown()
+            self._finish_stream(writer, forward_pass_use_cache)
+            if streamer is None:
+                self.pipeline_save_dir = pipeline_save_dir
+
         logger.info(f"Quantization summary:\n{quant_log}")
         for module_log in quant_log:
             logger.info(module_log)
 
+        if sweep_configs is not None:
+            # stage timings are shared by every config
+            return [
+                (quant_log + sweep_logs[k], sweep_layers[k], sweep_kernels[k], force_layer_back_to_cpu, device_map,
+                 forward_pass_use_cache)
+                for k in range(len(sweep_configs))
+            ]
+
         return quant_log, quantizers, force_layer_back_to_cpu, device_map, forward_pass_use_cache
 
-    def pack(self, quant_log, quantizers, force_layer_back_to_cpu, device_map, forward_pass_use_cache):
-        self.qlinear_kernel = pack_model(
-            model=self.model,
-            quantizers=quantizers,
-            bits=self.quantize_config.bits,
-            group_size=self.quantize_config.group_size,
-            backend=BACKEND.AUTO,
-            desc_act=self.quantize_config.desc_act,
-            force_layer_back_to_cpu=force_layer_back_to_cpu,
-            format=self.quantize_config.format,
+    def _finish_stream(self, writer: ShardWriter, use_cache: bool):
+        """Write the non-layer weights and the configs once every layer has been written by `writer`."""
+        layers_prefix = f"{self.layers_node}."
+        if self.layer_streamer is not None:
+            self.layer_streamer.materialize(self.model, skip=layers_prefix)
+            self.model.tie_weights()
+
+        state_dict = {}
+        seen = set()
+        for name, tensor in self.model.state_dict().items():
+            if name.startswith(layers_prefix) or tensor.device.type == "meta":
+                continue
+            # tied weights are saved as separate tensors, like save_quantized() does
+            state_dict[name] = tensor.clone() if tensor.data_ptr() in seen else tensor
+            seen.add(tensor.data_ptr())
+        writer.add(state_dict)
+        writer.finish()
+
+        self.quantize_config.meta_set_versionable(
+            key=META_FIELD_QUANTIZER,
+            value=META_QUANTIZER_GPTQMODEL,
+            version=__version__,
         )
+        config = copy.deepcopy(self.model.config)
+        # quantize() turns the kv cache off for its forwards
+        config.use_cache = use_cache
+        quantize_config = copy.deepcopy(self.quantize_config)
+        config.quantization_config = quantize_config.to_dict()
+        config.save_pretrained(writer.save_dir)
+
+        quantize_config.model_name_or_path = writer.save_dir
+        quantize_config.model_file_base_name = writer.model_base_name
+        quantize_config.save_pretrained(writer.save_dir)
+
+        self._quantized = True
+        logger.info(f"Quantized model saved to {writer.save_dir}")
+
+    def pack(
+        self,
+        quant_log,
+        quantizers,
+        force_layer_back_to_cpu,
+        device_map,
+        forward_pass_use_cache,
+        # number of layers packed concurrently, each worker holds a layer's weights and packed buffers
+        pack_workers: int = 1,
+        # torch/BLAS threads available to each pack worker
+        pack_threads_per_worker: int = 1,
+        # create each QuantLinear only when its layer is packed, so packing takes about the memory of the fp model
+        pack_low_memory: bool = False,
+    ):
+        if self.layer_streamer is not None:
+            logger.info(f"Layers were packed while streaming, the quantized model is in {self.stream_save_dir}")
+            return
+
+        if self.pipeline_save_dir is not None:
+            logger.info(f"Layers were packed while quantizing, the quantized model is in {self.pipeline_save_dir}")
+        else:
+            timer = self.stage_timer if self.stage_timer is not None else StageTimer()
+            # the reported peak is that of packing alone
+            rss_tracked = reset_peak_rss()
+            with timer.stage("pack"):
+                self.qlinear_kernel = pack_model(
+                    model=self.model,
+                    quantizers=quantizers,
+                    bits=self.quantize_config.bits,
+                    group_size=self.quantize_config.group_size,
+                    backend=BACKEND.AUTO,
+                    desc_act=self.quantize_config.desc_act,
+                    force_layer_back_to_cpu=force_layer_back_to_cpu,
+                    format=self.quantize_config.format,
+                    workers=pack_workers,
+                    threads_per_worker=pack_threads_per_worker,
+                    low_memory=pack_low_memory,
+                )
+            stat = timer.flush()
+            peak_rss = get_peak_rss() if rss_tracked else None
+            if peak_rss is not None:
+                stat["peak_rss"] = peak_rss
+            quant_log.append(stat)
+            logger.info(stat)
+            timer.emit(stat)
+
+        self._finish_pack(device_map, forward_pass_use_cache)
+        return quant_log
 
+    def _finish_pack(self, device_map, forward_pass_use_cache):
+        """Dispatch the packed model back to `device_map` and mark it quantized."""
         if device_map:
             self.model = remove_hook_from_module(self.model, recurse=True)
             self.model = simple_dispatch_model(self.model, device_map)
@@ -547,8 +1582,6 @@ class BaseGPTQModel(nn.Module):
                                        self.quantize_config.desc_act, repack=True)
             self.qlinear_kernel = BitBLASQuantLinear
 
-        return quant_log
-
     @property
     def device(self):
         if not self.hf_device_map:
@@ -608,6 +1641,11 @@ class BaseGPTQModel(nn.Module):
         if not self.quantized:
             raise ValueError("Save aborted as model is not quantized. Please call `quantize()` first.")
 
+        if self.layer_streamer is not None:
+            raise ValueError(
+                f"Layer-streamed models are written during `quantize()`, load the result from {self.stream_save_dir}."
+            )
+
         if model_base_name is None:
             model_base_name = (
                     self.quantize_config.model_file_base_name or
@@ -620,16 +1658,14 @@ class BaseGPTQModel(nn.Module):
             )
 
         # internal is always gptq v2 but allow users to pass gptq (v1) via config
+        transform = None
         if quantize_config.format == FORMAT.GPTQ:
-            # Model qzeros may be edited in place.
-            # TODO: avoid inplace modification of the weights
-            model = copy.deepcopy(self.model)
-            model = convert_gptq_v2_to_v1_format(
+            # qzeros are converted one tensor at a time while they are written, the model itself stays in v2
+            transform = gptq_v1_qzeros_transform(
                 model, quantize_config=quantize_config, qlinear_kernel=self.qlinear_kernel
             )
 
-        model.to(CPU)
-
+        # tensors are written from wherever they live, the model is neither moved nor cloned
         state_dict = model.state_dict()
 
         if quantize_config.model_file_base_name is None:
@@ -641,9 +1677,15 @@ class BaseGPTQModel(nn.Module):
             model_base_name = quantize_config.model_file_base_name
 
         if use_safetensors:
-            state_dict = {k: v.clone().contiguous() for k, v in state_dict.items()}
             model_save_name = model_base_name + ".safetensors"
+            safetensors_metadata = self._safetensors_metadata(safetensors_metadata)
+            # one pinned staging buffer for all shards, only allocated for cuda tensors
+            staging = StagingBuffer()
         else:
+            # saved tensors load on cpu
+            state_dict = {k: v.to(CPU) for k, v in state_dict.items()}
+            if transform is not None:
+                state_dict = {k: transform(k, v) for k, v in state_dict.items()}
             model_save_name = model_base_name + ".bin"
 
         if not self.qlinear_kernel.SUPPORTED_SHARDS and max_shard_size is not None:
@@ -652,45 +1694,13 @@ class BaseGPTQModel(nn.Module):
 
         if max_shard_size is None:
             if use_safetensors:
-                if safetensors_metadata is None:
-                    safetensors_metadata = {}
-                elif not isinstance(safetensors_metadata, dict):
-                    raise TypeError("safetensors_metadata must be a dictionary.")
-                else:
-                    logger.debug(f"Received safetensors_metadata: {safetensors_metadata}")
-                    new_safetensors_metadata = {}
-                    converted_keys = False
-                    for key, value in safetensors_metadata.items():
-                        if not isinstance(key, str) or not isinstance(value, str):
-                            converted_keys = True
-                            try:
-                                new_key = str(key)
-                                new_value = str(value)
-                            except Exception as e:
-                                raise TypeError(
-                                    f"safetensors_metadata: both keys and values must be strings and an error occured when trying to convert them: {e}"
-                                )
-                            if new_key in new_safetensors_metadata:
-                                logger.warning(
-                                    f"After converting safetensors_metadata keys to strings, the key '{new_key}' is duplicated. Ensure that all your metadata keys are strings to avoid overwriting."
-                                )
-                            new_safetensors_metadata[new_key] = new_value
-                    safetensors_metadata = new_safetensors_metadata
-                    if converted_keys:
-                        logger.debug(
-                            f"One or more safetensors_metadata keys or values had to be converted to str(). Final safetensors_metadata: {safetensors_metadata}"
-                        )
-
-                # Format is required to enable Accelerate to load the metadata
-                # otherwise it raises an OSError
-                safetensors_metadata["format"] = "pt"
-                safe_save(state_dict, join(save_dir, model_save_name), safetensors_metadata)
+                write_safetensors(join(save_dir, model_save_name), state_dict, safetensors_metadata, staging, transform)
             else:
                 logger.warning(
                     "We highly suggest saving quantized model using safetensors format for security reasons. Please set `use_safetensors=True` whenever possible.")
-                torch.save(model.state_dict(), join(save_dir, model_save_name))
+                torch.save(state_dict, join(save_dir, model_save_name))
         else:
-            # Shard checkpoint
+            # Shard checkpoint, the shards only reference the tensors of state_dict
             shards, index = shard_checkpoint(state_dict, max_shard_size=max_shard_size, weights_name=model_save_name)
 
             # Clean the folder from a previous save
@@ -709,40 +1719,10 @@ class BaseGPTQModel(nn.Module):
                 ):
                     os.remove(full_filename)
 
-            # Save the model
+            # Save the model, one shard file after the other
             for shard_file, shard in shards.items():
                 if use_safetensors:
-                    if safetensors_metadata is None:
-                        safetensors_metadata = {}
-                    elif not isinstance(safetensors_metadata, dict):
-                        raise TypeError("safetensors_metadata must be a dictionary.")
-                    else:
-                        logger.debug(f"Received safetensors_metadata: {safetensors_metadata}")
-                        new_safetensors_metadata = {}
-                        converted_keys = False
-                        for key, value in safetensors_metadata.items():
-                            if not isinstance(key, str) or not isinstance(value, str):
-                                converted_keys = True
-                                try:
-                                    new_key = str(key)
-                                    new_value = str(value)
-                                except Exception as e:
-                                    raise TypeError(
-                                        f"safetensors_metadata: both keys and values must be strings and an error occured when trying to convert them: {e}")
-                                if new_key in new_safetensors_metadata:
-                                    logger.warning(
-                                        f"After converting safetensors_metadata keys to strings, the key '{new_key}' is duplicated. Ensure that all your metadata keys are strings to avoid overwriting.")
-                                new_safetensors_metadata[new_key] = new_value
-                        safetensors_metadata = new_safetensors_metadata
-                        if converted_keys:
-                            logger.debug(
-                                f"One or more safetensors_metadata keys or values had to be converted to str(). Final safetensors_metadata: {safetensors_metadata}")
-
-                    # Format is required to enable Accelerate to load the metadata
-                    # otherwise it raises an OSError
-                    safetensors_metadata["format"] = "pt"
-
-                    safe_save(shard, join(save_dir, shard_file), safetensors_metadata)
+                    write_safetensors(join(save_dir, shard_file), shard, safetensors_metadata, staging, transform)
                 else:
                     torch.save(shard, join(save_dir, shard_file))
 
@@ -760,6 +1740,44 @@ class BaseGPTQModel(nn.Module):
         quantize_config.model_file_base_name = model_base_name
         quantize_config.save_pretrained(save_dir)
 
+    @staticmethod
+    def _safetensors_metadata(safetensors_metadata: Optional[Dict[str, str]]) -> Dict[str, str]:
+        if safetensors_metadata is None:
+            safetensors_metadata = {}
+        elif not isinstance(safetensors_metadata, dict):
+            raise TypeError("safetensors_metadata must be a dictionary.")
+        else:
+            logger.debug(f"Received safetensors_metadata: {safetensors_metadata}")
+            new_safetensors_metadata = {}
+            converted_keys = False
+            for key, value in safetensors_metadata.items():
+                if not isinstance(key, str) or not isinstance(value, str):
+                    converted_keys = True
+                    try:
+                        new_key = str(key)
+                        new_value = str(value)
+                    except Exception as e:
+                        raise TypeError(
+                            f"safetensors_metadata: both keys and values must be strings and an error occured when trying to convert them: {e}"
+                        )
+                    if new_key in new_safetensors_metadata:
+                        logger.warning(
+                            f"After converting safetensors_metadata keys to strings, the key '{new_key}' is duplicated. Ensure that all your metadata keys are strings to avoid overwriting."
+                        )
+                else:
+                    new_key, new_value = key, value
+                new_safetensors_metadata[new_key] = new_value
+            safetensors_metadata = new_safetensors_metadata
+            if converted_keys:
+                logger.debug(
+                    f"One or more safetensors_metadata keys or values had to be converted to str(). Final safetensors_metadata: {safetensors_metadata}"
+                )
+
+        # Format is required to enable Accelerate to load the metadata
+        # otherwise it raises an OSError
+        safetensors_metadata["format"] = "pt"
+        return safetensors_metadata
+
     def save_pretrained(
         self,
         save_dir: str,
@@ -775,9 +1793,16 @@ class BaseGPTQModel(nn.Module):
         quantize_config: QuantizeConfig,
         trust_remote_code: bool = False,
         torch_dtype: [str | torch.dtype] = "auto",
+        stream_save_dir: Optional[str] = None,
+        stream_max_shard_size: Optional[str] = "4GB",
         **model_init_kwargs,
     ):
-        """load un-quantized pretrained model to cpu"""
+        """load un-quantized pretrained model to cpu
+
+        With `stream_save_dir`, only the model skeleton is built (on the meta device). `quantize()` then reads one
+        layer at a time from the safetensors checkpoint, quantizes and packs it, writes it to `stream_save_dir` in
+        shards of `stream_max_shard_size` and frees it, so host RAM holds about one layer plus calibration data.
+        """
         got_cuda = check_cuda(raise_exception=False)
 
         if not got_cuda:
@@ -826,7 +1851,15 @@ class BaseGPTQModel(nn.Module):
         if model_init_kwargs.get("cpu") != "cpu":
             torch.cuda.empty_cache()
 
-        model = AutoModelForCausalLM.from_pretrained(pretrained_model_name_or_path, **model_init_kwargs)
+        layer_streamer = None
+        if stream_save_dir is not None:
+            with init_empty_weights():
+                model = AutoModelForCausalLM.from_config(
+                    config, torch_dtype=torch_dtype, trust_remote_code=trust_remote_code
+                )
+            layer_streamer = LayerStreamer(pretrained_model_name_or_path, torch_dtype)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(pretrained_model_name_or_path, **model_init_kwargs)
 
         model_config = model.config.to_dict()
         seq_len_keys = ["max_position_embeddings", "seq_length", "n_positions"]
@@ -840,7 +1873,12 @@ class BaseGPTQModel(nn.Module):
             model.seqlen = 4096
         model.eval()
 
-        return cls(model, quantized=False, quantize_config=quantize_config)
+        gptq_model = cls(model, quantized=False, quantize_config=quantize_config)
+        if layer_streamer is not None:
+            gptq_model.layer_streamer = layer_streamer
+            gptq_model.stream_save_dir = stream_save_dir
+            gptq_model.stream_max_shard_size = stream_max_shard_size
+        return gptq_model
 
     @classmethod
     def from_quantized(
@@ -1118,15 +2156,6 @@ class BaseGPTQModel(nn.Module):
         load_checkpoint_in_model = False
         # compat: runtime convert checkpoint gptq(v1) to gptq_v2 format
         if quantize_config.format == FORMAT.GPTQ:
-            accelerate.load_checkpoint_in_model(
-                model,
-                dtype=torch_dtype,
-                # This is very hacky but works due to https://github.com/huggingface/accelerate/blob/bd72a5f1a80d5146554458823f8aeda0a9db5297/src/accelerate/utils/modeling.py#L292
-                checkpoint=model_save_name,
-                device_map=device_map,
-                offload_state_dict=True,
-                offload_buffers=True,
-            )
             # validate sym=False v1 loading needs to be protected for models produced with new v2 format codebase
             if not quantize_config.sym and not quantize_config.is_quantized_or_packed_by_v2():
                 raise ValueError(
@@ -1135,10 +2164,13 @@ class BaseGPTQModel(nn.Module):
 
             logger.info(
                 f"Compatibility: converting `{FORMAT_FIELD_JSON}` from `{FORMAT.GPTQ}` to `{FORMAT.GPTQ_V2}`.")
-            model = convert_gptq_v1_to_v2_format(
+            # qzeros are converted one tensor at a time while they are loaded
+            load_checkpoint_with_transform(
                 model,
-                quantize_config=quantize_config,
-                qlinear_kernel=preload_qlinear_kernel,
+                checkpoint=model_save_name,
+                device_map=device_map,
+                dtype=torch_dtype,
+                transform=gptq_v2_qzeros_transform(layers, quantize_config=quantize_config),
             )
             load_checkpoint_in_model = True
             quantize_config.format = FORMAT.GPTQ_V2
@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import transformers
 from gptqmodel.nn_modules.qlinear import BaseQuantLinear
+from gptqmodel.utils.pack import pack_columns, pack_rows, quantize_weight
 from gptqmodel_exllama_kernels import make_q4, q4_matmul
 
 logger = getLogger(__name__)
@@ -119,7 +120,8 @@ class ExllamaQuantLinear(BaseQuantLinear):
         )
 
     def pack(self, linear, scales, zeros, g_idx=None):
-        W = linear.weight.data.clone()
+        # quantize_weight() reads W without modifying it
+        W = linear.weight.data
         if isinstance(linear, nn.Conv2d):
             W = W.flatten(1)
         if isinstance(linear, transformers.pytorch_utils.Conv1D):
@@ -134,42 +136,11 @@ class ExllamaQuantLinear(BaseQuantLinear):
         if linear.bias is not None:
             self.bias = linear.bias.clone().half()
 
-        intweight = []
-        for idx in range(self.original_infeatures):
-            intweight.append(
-                torch.round((W[:, idx] + scale_zeros[self.g_idx[idx]]) / self.scales[self.g_idx[idx]]).to(torch.int)[
-                    :, None
-                ]
-            )
-        intweight = torch.cat(intweight, dim=1)
-        intweight = intweight.t().contiguous()
-        intweight = intweight.numpy().astype(np.uint32)
-
-        i = 0
-        row = 0
-        qweight = np.zeros((intweight.shape[0] // 32 * self.bits, intweight.shape[1]), dtype=np.uint32)
-        while row < qweight.shape[0]:
-            for j in range(i, i + (32 // self.bits)):
-                qweight[row] |= intweight[j] << (self.bits * (j - i))
-            i += 32 // self.bits
-            row += 1
-
-        qweight = qweight.astype(np.int32)
-        self.qweight = torch.from_numpy(qweight)
+        intweight = quantize_weight(W, self.scales, scale_zeros, self.g_idx)
+        self.qweight = torch.from_numpy(pack_rows(intweight, self.bits))
 
         zeros = zeros.numpy().astype(np.uint32)
-        qzeros = np.zeros((zeros.shape[0], zeros.shape[1] // 32 * self.bits), dtype=np.uint32)
-        i = 0
-        col = 0
-        while col < qzeros.shape[1]:
-            for j in range(i, i + (32 // self.bits)):
-                qzeros[:, col] |= zeros[:, j] << (self.bits * (j - i))
-            i += 32 // self.bits
-            col += 1
-
-
-        qzeros = qzeros.astype(np.int32)
-        self.qzeros = torch.from_numpy(qzeros)
+        self.qzeros = torch.from_numpy(pack_columns(zeros, self.bits))
 
     def forward(self, x):
         if x.dtype != torch.float16:
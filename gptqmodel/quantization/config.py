@@ -81,6 +81,8 @@ class QuantizeConfig():
     damp_percent: float = field(default=0.01)
     desc_act: bool = field(default=True)
     static_groups: bool = field(default=False)
+    # search the per-group clipping range minimizing quantization error instead of using min/max
+    mse: bool = field(default=False)
     sym: bool = field(default=True)
     true_sequential: bool = field(default=True)
     lm_head: bool = field(default=False)
@@ -293,6 +295,7 @@ class QuantizeConfig():
             "group_size": self.group_size,
             "desc_act": self.desc_act,
             "static_groups": self.static_groups,
+            "mse": self.mse,
             "sym": self.sym,
             "lm_head": self.lm_head,
             "damp_percent": self.damp_percent,
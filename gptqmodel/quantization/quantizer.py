@@ -33,6 +33,7 @@ class Quantizer(nn.Module):
         grid=100,
         maxshrink=0.8,
         trits=False,
+        mse_chunk_bytes=256 * 1024**2,
     ):
         self.maxq = torch.tensor(2**bits - 1)
         self.perchannel = perchannel
@@ -41,6 +42,8 @@ class Quantizer(nn.Module):
         self.norm = norm
         self.grid = grid
         self.maxshrink = maxshrink
+        # memory budget for the intermediates of one batch of shrink candidates in the mse search
+        self.mse_chunk_bytes = mse_chunk_bytes
         if trits:
             self.maxq = torch.tensor(-1)
 
@@ -87,23 +90,7 @@ class Quantizer(nn.Module):
                 self.zero = torch.round(-xmin / self.scale)
 
         if self.mse:
-            best = torch.full([x.shape[0]], float("inf"), device=dev)
-            for i in range(int(self.maxshrink * self.grid)):
-                p = 1 - i / self.grid
-                xmin1 = p * xmin
-                xmax1 = p * xmax
-                scale1 = (xmax1 - xmin1) / self.maxq
-                zero1 = torch.round(-xmin1 / scale1) if not self.sym else self.zero
-                q = quantize(x, scale1.unsqueeze(1), zero1.unsqueeze(1), self.maxq)
-                q -= x
-                q.abs_()
-                q.pow_(self.norm)
-                err = torch.sum(q, 1)
-                tmp = err < best
-                if torch.any(tmp):
-                    best[tmp] = err[tmp]
-                    self.scale[tmp] = scale1[tmp]
-                    self.zero[tmp] = zero1[tmp]
+            self.search_shrink(x, xmin, xmax)
         if not self.perchannel:
             if weight:
                 tmp = shape[0]
@@ -127,6 +114,71 @@ class Quantizer(nn.Module):
             self.scale = self.scale.unsqueeze(0)
             self.zero = self.zero.unsqueeze(0)
 
+    def find_group_params(self, x, group_size):
+        """Compute the params of every `group_size` column group of weight `x` at once.
+
+        Returns `(scale, zero)` of shape `[rows, n_groups]`; the last group may be partial.
+        Leaves `scale`/`zero` of the last group on the quantizer.
+        """
+        rows, columns = x.shape
+        full = columns - columns % group_size
+        if not self.perchannel:
+            chunks = [x[:, i : (i + group_size)] for i in range(0, columns, group_size)]
+        else:
+            # [rows, n_groups, group_size] -> one row per (row, group) pair
+            chunks = [x[:, :full].reshape(-1, group_size)] if full else []
+            if full != columns:
+                chunks.append(x[:, full:])
+
+        scale = []
+        zero = []
+        for chunk in chunks:
+            self.find_params(chunk, weight=True)
+            scale.append(self.scale.reshape(rows, -1))
+            zero.append(self.zero.reshape(rows, -1))
+        scale = torch.cat(scale, dim=1)
+        zero = torch.cat(zero, dim=1)
+        self.scale = scale[:, -1:]
+        self.zero = zero[:, -1:]
+        return scale, zero
+
+    def search_shrink(self, x, xmin, xmax):
+        """Pick the per-row shrink factor of the `[xmin, xmax]` range that minimizes the quantization error.
+
+        Shrink candidates are evaluated in batches of `[k, rows, columns]`, `k` is chosen so the
+        intermediates of one batch stay within `mse_chunk_bytes`.
+        """
+        steps = int(self.maxshrink * self.grid)
+        if steps <= 0:
+            return
+
+        # quantize() keeps ~3 float32 temporaries of the candidate batch alive
+        k = max(1, min(steps, self.mse_chunk_bytes // (3 * 4 * x.numel())))
+        best = torch.full([x.shape[0]], float("inf"), device=x.device)
+
+        for i1 in range(0, steps, k):
+            i2 = min(i1 + k, steps)
+            p = 1 - torch.arange(i1, i2, device=x.device, dtype=torch.float64).unsqueeze(1) / self.grid
+            p = p.to(xmin.dtype)
+            xmin1 = p * xmin
+            xmax1 = p * xmax
+            scale1 = (xmax1 - xmin1) / self.maxq
+            zero1 = torch.round(-xmin1 / scale1) if not self.sym else self.zero.expand_as(scale1)
+            q = quantize(x, scale1.unsqueeze(2), zero1.unsqueeze(2), self.maxq)
+            q -= x
+            q.abs_()
+            q.pow_(self.norm)
+            err = torch.sum(q, 2)
+            del q
+
+            # first candidate wins on ties, as in a sequential scan with a strict `<`
+            idx = torch.argmin(err, dim=0, keepdim=True)
+            err = err.gather(0, idx).squeeze(0)
+            tmp = err < best
+            best = torch.where(tmp, err, best)
+            self.scale = torch.where(tmp, scale1.gather(0, idx).squeeze(0), self.scale)
+            self.zero = torch.where(tmp, zero1.gather(0, idx).squeeze(0), self.zero)
+
     def quantize(self, x):
         if self.ready():
             return quantize(x, self.scale, self.zero, self.maxq)
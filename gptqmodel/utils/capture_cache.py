@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+from logging import getLogger
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+from ..models._const import CPU
+
+
+logger = getLogger(__name__)
+
+
+class CaptureCache:
+    """
+    Captured inputs of the first layer, reused by later `quantize()` runs of the same base model.
+
+    Each capture is saved as `{fingerprint}.pt` in `path`. The fingerprint covers everything the capture depends on:
+    the model config, the weights of the modules that run before the first layer, the calibration token ids
+    and the batching options. Quantize configs (bits, group size, ...) are not part of it, so runs at several
+    bit widths share one capture.
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.fingerprint = fingerprint
+
+    @property
+    def file(self) -> str:
+        return os.path.join(self.path, f"{self.fingerprint}.pt")
+
+    @staticmethod
+    def compute_fingerprint(model: nn.Module, modules: List[nn.Module], calibration_dataset: List[Dict], options: Dict) -> str:
+        digest = hashlib.sha256()
+        digest.update(model.config.to_json_string(use_diff=False).encode())
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+
+        for module in modules:
+            for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+                digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+                # raw bytes, so bfloat16 hashes without a numpy dtype
+                digest.update(tensor.detach().to(CPU).contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+        for example in calibration_dataset:
+            for key in ("input_ids", "attention_mask"):
+                digest.update(torch.as_tensor(example[key], dtype=torch.long).numpy().tobytes())
+            digest.update(b"|")
+
+        return digest.hexdigest()
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.file)
+
+    def save(self, capture: Dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = f"{self.file}.tmp"
+        torch.save(capture, tmp)
+        os.replace(tmp, self.file)
+        logger.info(f"Saved captured calibration inputs to {self.file}")
+
+    def load(self, map_location: Optional[torch.device] = CPU) -> Dict:
+        logger.info(f"Reusing captured calibration inputs from {self.file}")
+        return torch.load(self.file, map_location=map_location, weights_only=False)
+
+
+__all__ = ["CaptureCache"]
@@ -0,0 +1,138 @@
+import json
+import os
+from logging import getLogger
+from typing import Dict, List, Optional
+
+import torch
+
+from ..models._const import CPU
+from ..quantization.config import META_FIELD
+
+logger = getLogger(__name__)
+
+
+class QuantizeCheckpoint:
+    """
+    Per-layer state of a `quantize()` run so an interrupted run can resume from the first unfinished layer.
+
+    Layout of `path`:
+        meta.json       quantize config, layer/batch count and number of finished layers
+        shared.pt       attention masks, position ids and extra layer kwargs, identical for every layer
+        layer-{i}.pt    quantized weights, quantizers and quant_log entries of layer `i`
+        inputs.pt       cached inputs of the first unfinished layer
+
+    Files are written to a temporary name and renamed into place, `meta.json` last, so a run killed
+    mid-write leaves the previous consistent state behind.
+    """
+
+    META_FILE = "meta.json"
+    SHARED_FILE = "shared.pt"
+    INPUTS_FILE = "inputs.pt"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save(self, obj, name: str):
+        tmp = self._file(f"{name}.tmp")
+        torch.save(obj, tmp)
+        os.replace(tmp, self._file(name))
+
+    def _load(self, name: str, map_location=CPU):
+        # quantizers are pickled `Quantizer` modules, tensors saved from any device are mapped to `map_location`
+        return torch.load(self._file(name), map_location=map_location, weights_only=False)
+
+    def _write_meta(self):
+        tmp = self._file(f"{self.META_FILE}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp, self._file(self.META_FILE))
+
+    @staticmethod
+    def _config_dict(quantize_config) -> Dict:
+        config = quantize_config.to_dict()
+        config.pop(META_FIELD, None)
+        # normalize enums and tuples the same way a json round trip does
+        return json.loads(json.dumps(config))
+
+    @property
+    def finished_layers(self) -> int:
+        return self.meta["finished_layers"] if self.meta else 0
+
+    def exists(self) -> bool:
+        return os.path.isfile(self._file(self.META_FILE))
+
+    def start(
+        self,
+        quantize_config,
+        layer_count: int,
+        num_batches: int,
+        attention_masks: List,
+        position_ids: List,
+        layer_input_kwargs: List[Dict],
+    ):
+        os.makedirs(self.path, exist_ok=True)
+        self._save(
+            {
+                "attention_masks": attention_masks,
+                "position_ids": position_ids,
+                "layer_input_kwargs": layer_input_kwargs,
+            },
+            self.SHARED_FILE,
+        )
+        self.meta = {
+            "quantize_config": self._config_dict(quantize_config),
+            "layer_count": layer_count,
+            "num_batches": num_batches,
+            "finished_layers": 0,
+        }
+        self._write_meta()
+
+    def save_layer(self, index: int, weights: Dict, quantizers: Dict, quant_log: List[Dict], next_layer_inputs: List):
+        if index != self.finished_layers:
+            raise ValueError(f"Layer {index} checkpointed out of order, expected layer {self.finished_layers}.")
+
+        self._save(
+            {
+                "weights": weights,
+                "quantizers": quantizers,
+                "quant_log": quant_log,
+            },
+            f"layer-{index}.pt",
+        )
+        self._save(next_layer_inputs, self.INPUTS_FILE)
+
+        self.meta["finished_layers"] = index + 1
+        self._write_meta()
+        logger.info(f"Checkpointed layer {index + 1} of {self.meta['layer_count']} to {self.path}")
+
+    def load(self, quantize_config, layer_count: int, num_batches: int, map_location: Optional[torch.device] = None):
+        """Validate the checkpoint against this run and load the state shared by all layers."""
+        with open(self._file(self.META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        if meta["quantize_config"] != self._config_dict(quantize_config):
+            raise ValueError(f"Checkpoint at {self.path} was created with a different quantize config.")
+        if meta["layer_count"] != layer_count or meta["num_batches"] != num_batches:
+            raise ValueError(
+                f"Checkpoint at {self.path} was created for {meta['layer_count']} layers and {meta['num_batches']} "
+                f"calibration batches, got {layer_count} layers and {num_batches} batches."
+            )
+
+        self.meta = meta
+        shared = self._load(self.SHARED_FILE, map_location=map_location or CPU)
+        return shared["attention_masks"], shared["position_ids"], shared["layer_input_kwargs"]
+
+    def load_layer(self, index: int):
+        """Return `(weights, quantizers, quant_log)` of a finished layer."""
+        state = self._load(f"layer-{index}.pt")
+        return state["weights"], state["quantizers"], state["quant_log"]
+
+    def load_inputs(self, map_location: Optional[torch.device] = None) -> List:
+        return self._load(self.INPUTS_FILE, map_location=map_location or CPU)
+
+
+__all__ = ["QuantizeCheckpoint"]
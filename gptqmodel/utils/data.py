@@ -168,6 +168,39 @@ def collate_data(blocks: List[Dict[str, List[List[int]]]], pad_token_id: int) ->
     }
 
 
+def pack_data(blocks: List[Dict[str, List[List[int]]]], dtype: torch.dtype) -> Dict[str, torch.Tensor]:
+    """Pack every row of `blocks` into a single sequence without padding.
+
+    Masked tokens of each row are dropped. `position_ids` restart at 0 for every row and the
+    `attention_mask` is an inverted 4D mask (0 to attend, `dtype` min otherwise) of shape
+    `[1, 1, tokens, tokens]` that keeps attention causal within each row.
+
+    The mask is dense, so it takes `tokens ** 2` elements of `dtype` per layer forward and attention
+    still computes the masked scores between rows; packing saves the padding, not the cross-row work.
+    Callers should keep `tokens` bounded, quantize() caps it at `calibration_pack_max_tokens`.
+    """
+    rows = [
+        [token for token, mask in zip(input_ids, attention_mask) if mask]
+        for block in blocks
+        for input_ids, attention_mask in zip(block["input_ids"], block["attention_mask"])
+    ]
+    rows = [row for row in rows if row]
+    lengths = LongTensor([len(row) for row in rows])
+
+    input_ids = LongTensor([token for row in rows for token in row])
+    position_ids = torch.cat([torch.arange(length) for length in lengths.tolist()])
+    row_ids = torch.repeat_interleave(torch.arange(len(rows)), lengths)
+    index = torch.arange(len(input_ids))
+    attend = (row_ids[:, None] == row_ids[None, :]) & (index[None, :] <= index[:, None])
+    attention_mask = torch.zeros(attend.shape, dtype=dtype).masked_fill_(~attend, torch.finfo(dtype).min)
+
+    return {
+        "input_ids": input_ids.unsqueeze(0),
+        "attention_mask": attention_mask[None, None],
+        "position_ids": position_ids.unsqueeze(0),
+    }
+
+
 def get_dataloader(
     data_path_or_name: str,
     prompt_col_name: str,
@@ -1,3 +1,8 @@
+import ctypes
+import functools
+import sys
+from typing import Optional
+
 import torch
 
 
@@ -11,3 +16,44 @@ def check_cuda(raise_exception: bool = True) -> bool:
             return False
     else:
         return True
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident set size of this process to its current one, so `get_peak_rss()` covers only what runs
+    afterwards. Returns False where the platform does not allow it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in bytes since `reset_peak_rss()`, None where it is not reported."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    # reported in kB
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _libc() -> Optional[ctypes.CDLL]:
+    try:
+        return ctypes.CDLL("libc.so.6")
+    except OSError:
+        return None
+
+
+def trim_host_memory():
+    """Hand freed heap memory back to the os, glibc otherwise keeps it for reuse and it still counts as resident."""
+    libc = _libc() if sys.platform == "linux" else None
+    if libc is not None and hasattr(libc, "malloc_trim"):
+        libc.malloc_trim(0)
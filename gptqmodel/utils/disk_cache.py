@@ -0,0 +1,137 @@
+import os
+import tempfile
+import threading
+from typing import Union
+
+import numpy as np
+import torch
+from accelerate.utils import convert_file_size_to_int
+
+from ..models._const import CPU
+
+
+class _Spilled:
+    """Location of a tensor written to the file of a `DiskTensorList`."""
+
+    __slots__ = ("offset", "nbytes", "dtype", "shape")
+
+    def __init__(self, offset: int, nbytes: int, dtype: torch.dtype, shape: torch.Size):
+        self.offset = offset
+        self.nbytes = nbytes
+        self.dtype = dtype
+        self.shape = shape
+
+
+class DiskCache:
+    """
+    Host memory budget shared by all `DiskTensorList` of one `quantize()` run.
+
+    Tensors are kept in RAM while the budget allows, later ones are appended to a file under `path`
+    and memory-mapped back on access, so only the pages of the batch being forwarded are resident.
+    """
+
+    def __init__(self, path: str, max_memory: Union[int, str] = 0):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        # "10GB" style strings as accepted by `max_memory` elsewhere
+        self.max_memory = convert_file_size_to_int(max_memory)
+        self.resident = 0
+        # lists are appended to from the fp_layer_inputs worker threads too
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes: int) -> bool:
+        """Count `nbytes` as resident if the budget allows it, returns whether it did."""
+        with self.lock:
+            if self.resident + nbytes > self.max_memory:
+                return False
+            self.resident += nbytes
+            return True
+
+    def release(self, nbytes: int):
+        with self.lock:
+            self.resident -= nbytes
+
+    def list(self) -> "DiskTensorList":
+        return DiskTensorList(self)
+
+
+class DiskTensorList:
+    """
+    Append-only list of per-batch tensors, lists/tuples of tensors or `None`, backed by a `DiskCache`.
+
+    Items come back as cpu tensors; spilled tensors are copy-on-write views of the memory map.
+    Pickles as a plain list so it can be checkpointed like one.
+    """
+
+    def __init__(self, cache: DiskCache):
+        self.cache = cache
+        self.items = []
+        self.resident = 0
+        self.size = 0
+        fd, self.file = tempfile.mkstemp(dir=cache.path, suffix=".bin")
+        self.writer = os.fdopen(fd, "wb")
+
+    def _store(self, t):
+        if not isinstance(t, torch.Tensor):
+            return t
+
+        t = t.detach().to(CPU)
+        nbytes = t.numel() * t.element_size()
+        if self.cache.reserve(nbytes):
+            self.resident += nbytes
+            return t
+
+        self.writer.write(memoryview(t.contiguous().reshape(-1).view(torch.uint8).numpy()))
+        spilled = _Spilled(self.size, nbytes, t.dtype, t.shape)
+        self.size += nbytes
+        return spilled
+
+    def _load(self, t):
+        if not isinstance(t, _Spilled):
+            return t
+
+        if not self.writer.closed:
+            self.writer.flush()
+        data = np.memmap(self.file, dtype=np.uint8, mode="c", offset=t.offset, shape=(t.nbytes,))
+        return torch.from_numpy(data).view(t.dtype).reshape(t.shape)
+
+    def append(self, item):
+        if isinstance(item, (list, tuple)):
+            item = type(item)(self._store(t) for t in item)
+        else:
+            item = self._store(item)
+        self.items.append(item)
+
+    def __getitem__(self, index: int):
+        item = self.items[index]
+        if isinstance(item, (list, tuple)):
+            return type(item)(self._load(t) for t in item)
+        return self._load(item)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self):
+        for index in range(len(self.items)):
+            yield self[index]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def close(self):
+        """Drop all items, give the resident bytes back to the cache and delete the file."""
+        if self.writer.closed:
+            return
+        self.writer.close()
+        self.items = []
+        self.cache.release(self.resident)
+        self.resident = 0
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+    def __del__(self):
+        if hasattr(self, "writer"):
+            self.close()
+
+
+__all__ = ["DiskCache", "DiskTensorList"]
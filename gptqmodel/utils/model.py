@@ -5,7 +5,7 @@ import json
 import logging
 import os
 from logging import getLogger
-from typing import List, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Union
 
 import accelerate
 import threadpoolctl as tctl
@@ -25,7 +25,9 @@ from ..nn_modules.qlinear.qlinear_marlin import MarlinQuantLinear
 from ..nn_modules.qlinear.qlinear_qbits import QBitsQuantLinear
 from ..quantization import FORMAT, QuantizeConfig
 from .backend import BACKEND
+from .device import get_peak_rss, reset_peak_rss, trim_host_memory
 from .importer import select_quant_linear
+from .pack import convert_qzeros_v1_to_v2, convert_qzeros_v2_to_v1, qzeros_ones
 
 logger = getLogger(__name__)
 handler = logging.StreamHandler()
@@ -133,67 +135,52 @@ def make_quant(
 
     for name, submodule in module.named_modules():
         if name in names:
-            ori_layer_device = next(submodule.parameters()).device
-
-            if isinstance(submodule, nn.Linear):
-                in_features = submodule.in_features
-                out_features = submodule.out_features
-            elif isinstance(submodule, nn.Conv2d):
-                in_features = submodule.in_channels
-                out_features = submodule.out_channels
-            elif isinstance(submodule, transformers.pytorch_utils.Conv1D):
-                in_features = submodule.weight.shape[0]
-                out_features = submodule.weight.shape[1]
-            else:
-                raise NotImplementedError(f"Unsupported module {submodule}")
-
-            bias = submodule.bias is not None
-            new_layer = QuantLinear(
-                bits=bits,
-                group_size=group_size,
-                desc_act=desc_act,
-                sym=sym,
-                infeatures=in_features,
-                outfeatures=out_features,
-                bias=bias,
-                weight_dtype=submodule.weight.dtype,
-            )
-            new_layer.device = ori_layer_device
-            recurse_setattr(module, name, new_layer.to(ori_layer_device))
+            new_layer = create_quant_layer(submodule, QuantLinear, bits, group_size, desc_act, sym)
+            recurse_setattr(module, name, new_layer.to(new_layer.device))
 
     return QuantLinear
 
+def create_quant_layer(submodule, QuantLinear, bits: int, group_size: int, desc_act: bool, sym: bool) -> BaseQuantLinear:
+    """Build the `QuantLinear` replacing `submodule` on cpu, its `device` attribute holds the device of `submodule`."""
+    if isinstance(submodule, nn.Linear):
+        in_features = submodule.in_features
+        out_features = submodule.out_features
+    elif isinstance(submodule, nn.Conv2d):
+        in_features = submodule.in_channels
+        out_features = submodule.out_channels
+    elif isinstance(submodule, transformers.pytorch_utils.Conv1D):
+        in_features = submodule.weight.shape[0]
+        out_features = submodule.weight.shape[1]
+    else:
+        raise NotImplementedError(f"Unsupported module {submodule}")
+
+    new_layer = QuantLinear(
+        bits=bits,
+        group_size=group_size,
+        desc_act=desc_act,
+        sym=sym,
+        infeatures=in_features,
+        outfeatures=out_features,
+        bias=submodule.bias is not None,
+        weight_dtype=submodule.weight.dtype,
+    )
+    new_layer.device = next(submodule.parameters()).device
+    return new_layer
+
 def convert_gptq_v1_to_v2_format(
     model,
     quantize_config: QuantizeConfig,
     qlinear_kernel: nn.Module,
 ):
-    # Limit thread usage to avoid auto-parallizataion regression
-    with tctl.threadpool_limits(limits=1):
-        for _, submodule in model.named_modules():
-            # v1 checkpoint format used to do `qzeros = qzeros -= 1` before serialization, thus the
-            # additions here do not overflow.
-            # v1 checkpoint format with sym=False saved via convert_gptq_v2_to_v1_format() will
-            # overflow ~<=13% based on testing
-            if isinstance(submodule, qlinear_kernel):
-                if quantize_config.bits == 2:
-                    submodule.qzeros.data += 0b01010101010101010101010101010101
-                elif quantize_config.bits == 3:
-                    submodule.qzeros.data[:, range(0, submodule.qzeros.data.shape[1], 3)] += (
-                        0b00100100100100100100100100100100
-                    )
-                    submodule.qzeros.data[:, range(1, submodule.qzeros.data.shape[1], 3)] += (
-                        0b10010010010010010010010010010010
-                    )
-                    submodule.qzeros.data[:, range(2, submodule.qzeros.data.shape[1], 3)] += (
-                        0b01001001001001001001001001001001
-                    )
-                elif quantize_config.bits == 4:
-                    submodule.qzeros.data += 0b00010001000100010001000100010001
-                elif quantize_config.bits == 8:
-                    submodule.qzeros.data += 0b00000001000000010000000100000001
-                else:
-                    raise NotImplementedError("Only 2,3,4,8 bits are supported.")
+    for _, submodule in model.named_modules():
+        # v1 checkpoint format used to do `qzeros = qzeros -= 1` before serialization, thus the
+        # additions here do not overflow.
+        # v1 checkpoint format with sym=False saved via convert_gptq_v2_to_v1_format() will
+        # overflow ~<=13% based on testing
+        if isinstance(submodule, qlinear_kernel):
+            submodule.qzeros.data += qzeros_ones(
+                quantize_config.bits, submodule.qzeros.shape[-1], submodule.qzeros.device
+            )
 
     return model
 
@@ -203,30 +190,110 @@ def convert_gptq_v2_to_v1_format(
     quantize_config: QuantizeConfig,
     qlinear_kernel: nn.Module,
 ):
-    # Limit thread usage to avoid auto-parallizataion regression
-    with tctl.threadpool_limits(limits=1):
-        for _, submodule in model.named_modules():
-            # sym=False has underflow probability of ~<=13% during testing. No underflow possible for sym=True.
-            if isinstance(submodule, qlinear_kernel):
-                if quantize_config.bits == 2:
-                    submodule.qzeros.data -= 0b01010101010101010101010101010101
-                elif quantize_config.bits == 3:
-                    submodule.qzeros.data[:, range(0, submodule.qzeros.data.shape[1], 3)] -= (
-                        0b00100100100100100100100100100100
-                    )
-                    submodule.qzeros.data[:, range(1, submodule.qzeros.data.shape[1], 3)] -= (
-                        0b10010010010010010010010010010010
-                    )
-                    submodule.qzeros.data[:, range(2, submodule.qzeros.data.shape[1], 3)] -= (
-                        0b01001001001001001001001001001001
-                    )
-                elif quantize_config.bits == 4:
-                    submodule.qzeros.data -= 0b00010001000100010001000100010001
-                elif quantize_config.bits == 8:
-                    submodule.qzeros.data -= 0b00000001000000010000000100000001
-                else:
-                    raise NotImplementedError("Only 2,3,4,8 bits are supported.")
+    for _, submodule in model.named_modules():
+        # sym=False has underflow probability of ~<=13% during testing. No underflow possible for sym=True.
+        if isinstance(submodule, qlinear_kernel):
+            submodule.qzeros.data -= qzeros_ones(
+                quantize_config.bits, submodule.qzeros.shape[-1], submodule.qzeros.device
+            )
+
+    return model
+
+
+def gptq_v1_qzeros_transform(
+    model,
+    quantize_config: QuantizeConfig,
+    qlinear_kernel: nn.Module,
+) -> Callable[[str, torch.Tensor], torch.Tensor]:
+    """
+    Returns a `write_safetensors()` transform that converts the gptq v2 qzeros of `model`'s `qlinear_kernel`
+    modules to v1 as they are written, the state dict names of all other tensors pass through unchanged.
+    """
+    qzeros_names = {
+        f"{name}.qzeros" for name, submodule in model.named_modules() if isinstance(submodule, qlinear_kernel)
+    }
+
+    def transform(name: str, tensor: torch.Tensor) -> torch.Tensor:
+        if name in qzeros_names:
+            return convert_qzeros_v2_to_v1(tensor, quantize_config.bits)
+        return tensor
+
+    return transform
+
+
+def gptq_v2_qzeros_transform(
+    qlinear_names: Iterable[str],
+    quantize_config: QuantizeConfig,
+) -> Callable[[str, torch.Tensor], torch.Tensor]:
+    """
+    Returns a `load_checkpoint_with_transform()` transform that converts the gptq v1 qzeros of the quantized modules
+    `qlinear_names` to v2 as they are loaded.
+    """
+    qzeros_names = {f"{name}.qzeros" for name in qlinear_names}
 
+    def transform(name: str, tensor: torch.Tensor) -> torch.Tensor:
+        if name in qzeros_names:
+            return convert_qzeros_v1_to_v2(tensor, quantize_config.bits)
+        return tensor
+
+    return transform
+
+
+def load_checkpoint_with_transform(
+    model,
+    checkpoint: str,
+    device_map: Dict[str, Union[int, str, torch.device]],
+    dtype: Optional[torch.dtype] = None,
+    transform: Optional[Callable[[str, torch.Tensor], torch.Tensor]] = None,
+):
+    """
+    `accelerate.load_checkpoint_in_model()` without disk offload, which hands every tensor of the checkpoint file or
+    shard index `checkpoint` to `transform(name, tensor)` right after it is read, before it is set on `model`.
+    """
+    if "disk" in device_map.values():
+        raise ValueError(
+            "At least one of the model submodule will be offloaded to disk, which is not supported for this checkpoint."
+        )
+
+    tied_params = accelerate.utils.modeling.find_tied_parameters(model)
+
+    if checkpoint.endswith(".json"):
+        with open(checkpoint, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        index = index.get("weight_map", index)
+        checkpoint_files = [os.path.join(os.path.dirname(checkpoint), f) for f in sorted(set(index.values()))]
+    else:
+        checkpoint_files = [checkpoint]
+
+    model_keys = set(model.state_dict().keys())
+    unexpected_keys = set()
+    for checkpoint_file in checkpoint_files:
+        loaded_checkpoint = accelerate.utils.modeling.load_state_dict(checkpoint_file, device_map=device_map)
+        for name in list(loaded_checkpoint):
+            tensor = loaded_checkpoint.pop(name)
+            if name not in model_keys:
+                unexpected_keys.add(name)
+                continue
+
+            module_name = name
+            while module_name and module_name not in device_map:
+                module_name = module_name.rpartition(".")[0]
+            if module_name not in device_map:
+                raise ValueError(f"{name} doesn't have any device set.")
+
+            if transform is not None:
+                tensor = transform(name, tensor)
+            accelerate.utils.modeling.set_module_tensor_to_device(
+                model, name, device_map[module_name], value=tensor, dtype=dtype
+            )
+
+    if unexpected_keys:
+        logger.warning(
+            f"Some weights of the model checkpoint at {checkpoint} were not used when initializing "
+            f"{model.__class__.__name__}: {unexpected_keys}."
+        )
+
+    accelerate.utils.modeling.retie_parameters(model, tied_params)
     return model
 
 def select_quant_linear_with_pack(bits: int,
@@ -261,7 +328,26 @@ def pack_model(
     desc_act=False,
     sym: bool = True,
     force_layer_back_to_cpu: bool = False,
+    workers: int = 1,
+    threads_per_worker: Optional[int] = 1,
+    low_memory: bool = False,
 ):
+    """Replace the quantized layers of `model` with packed `QuantLinear` modules, `workers` layers at a time.
+
+    Every layer is packed into its own module, so the result does not depend on `workers`. Each worker may use
+    `threads_per_worker` torch/BLAS threads, the default of 1 avoids auto-parallelizing the many small ops. None
+    leaves the thread limits as they are, for packing next to other work.
+
+    Every fp layer is released once it is packed. With `low_memory`, each `QuantLinear` is also created only when
+    its layer is packed instead of all up front, so the fp weights still to pack plus the packed ones take about
+    the memory of the fp model.
+    """
+    if workers < 1 or (threads_per_worker is not None and threads_per_worker < 1):
+        raise ValueError(f"workers and threads_per_worker must be at least 1, got {workers} and {threads_per_worker}.")
+
+    # the peak logged below is that of packing, not of loading or quantizing the model
+    rss_tracked = reset_peak_rss()
+
     QuantLinear = select_quant_linear_with_pack(
         bits=bits,
         group_size=group_size,
@@ -278,52 +364,67 @@ def pack_model(
     logger.info("Packing model...")
     layers = find_layers(model)
     layers = {n: layers[n] for n in quantizers}
-    make_quant(
-        model,
-        quantizers,
-        bits,
-        group_size,
-        backend=backend,
-        format=format,
-        desc_act=desc_act,
-        pack=True,
-    )
-    qlayers = find_layers(model, [QuantLinear])
-
-    # Limit pack() thread usage to avoid auto-parallizataion regression
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        # future_to_item = {executor.submit(pack_layer, quantizers[name], qlayers[name], layers[name], QuantLinear): name for name in qlayers.keys()}
-        # for future in tqdm(as_completed(future_to_item), total=len(qlayers.keys())):
-        #     item = future_to_item[future]
-        #     result = future.result()
-        #     print(f"Processed {item} to {result}")
-        futures = [(executor.submit(pack_layer, quantizers[name], qlayers[name], layers[name], QuantLinear), name) for name in qlayers.keys()]
-        for item in futures:
-            future, name = item
-            future.result()
-            print(f"{name} Processed")
-
-    logger.info("Model packed.")
+    if not low_memory:
+        make_quant(
+            model,
+            quantizers,
+            bits,
+            group_size,
+            backend=backend,
+            format=format,
+            desc_act=desc_act,
+            pack=True,
+        )
+        qlayers = find_layers(model, [QuantLinear])
+
+    def pack_one(name):
+        # the last reference to the fp layer, once it is replaced in the model
+        layer = layers.pop(name)
+        if low_memory:
+            qlayer = create_quant_layer(layer, QuantLinear, bits, group_size, desc_act, sym)
+            pack_layer(quantizers[name], qlayer, layer, QuantLinear)
+            recurse_setattr(model, name, qlayer)
+            del layer
+            # the freed fp weight and packing buffers would otherwise stay resident
+            trim_host_memory()
+        else:
+            pack_layer(quantizers[name], qlayers[name], layer, QuantLinear)
+
+    # thread limits are process wide, so they are set once for all workers instead of per layer
+    num_threads = torch.get_num_threads()
+    if threads_per_worker is not None:
+        torch.set_num_threads(threads_per_worker)
+    try:
+        with tctl.threadpool_limits(limits=threads_per_worker), ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(pack_one, name) for name in list(layers)]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Packing"):
+                future.result()
+    finally:
+        if threads_per_worker is not None:
+            torch.set_num_threads(num_threads)
+
+    peak_rss = get_peak_rss() if rss_tracked else None
+    logger.info("Model packed." if peak_rss is None else f"Model packed, peak RSS {peak_rss / 1024 ** 3:.2f} GiB.")
 
     return QuantLinear
 
 def pack_layer(quantizer, qlayer, layer, QuantLinear):
-    with tctl.threadpool_limits(limits=1):
-        _quantizer, scale, zero, g_idx = quantizer
-        # so far can only pack layer on CPU
-        layer_device = qlayer.device
-        qlayer.to(CPU)
-        layer, scale, zero, g_idx = (
-            layer.to(CPU),
-            scale.to(CPU),
-            zero.to(CPU),
-            g_idx.to(CPU),
-        )
-        if QuantLinear is MarlinQuantLinear:
-            qlayer.pack(layer, scale)
-        else:
-            qlayer.pack(layer, scale, zero, g_idx)
-        qlayer.to(layer_device)
+    # thread limits are set by the caller, see pack_model()
+    _quantizer, scale, zero, g_idx = quantizer
+    # so far can only pack layer on CPU
+    layer_device = qlayer.device
+    qlayer.to(CPU)
+    layer, scale, zero, g_idx = (
+        layer.to(CPU),
+        scale.to(CPU),
+        zero.to(CPU),
+        g_idx.to(CPU),
+    )
+    if QuantLinear is MarlinQuantLinear:
+        qlayer.pack(layer, scale)
+    else:
+        qlayer.pack(layer, scale, zero, g_idx)
+    qlayer.to(layer_device)
 
 
 def verify_model_hash(file_path: str, verify_hash: str):
@@ -636,6 +737,16 @@ def get_moe_layer_modules(layer_modules: List, num_experts: int) -> List:
 
     return new_inside_layer_modules
 
+
+# name of the sparse moe block holding the experts of `layer_modules`, None for dense layers
+def get_moe_block_name(layer_modules: List) -> Optional[str]:
+    for names in layer_modules:
+        for n in names:
+            if ".experts." in n:
+                return n.split(".experts.")[0]
+    return None
+
+
 def check_to_quantized(config):
     if isinstance(config, dict):
         if config["bits"] > 8 or "fp" in config["data_type"] or "float" in config["data_type"]:
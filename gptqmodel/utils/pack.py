@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+
+
+SUPPORTED_PACK_BITS = [2, 3, 4, 8]
+
+
+def quantize_weight(W: torch.Tensor, scales: torch.Tensor, scale_zeros: torch.Tensor, g_idx: torch.Tensor) -> np.ndarray:
+    """
+    Round the `(outfeatures, infeatures)` weight `W` to its integer levels, `round((W + scale_zeros) / scales)` with
+    the rows of `scales` and `scale_zeros` picked by `g_idx`. Returns a `(infeatures, outfeatures)` uint32 array.
+    """
+    g_idx = g_idx.long()
+    # cast up front like the mixed dtype ops would, so the results stay bit identical but run in place
+    add_dtype = torch.promote_types(W.dtype, scale_zeros.dtype)
+    div_dtype = torch.promote_types(add_dtype, scales.dtype)
+
+    intweight = W.t().to(add_dtype, memory_format=torch.contiguous_format, copy=True)
+    intweight.add_(scale_zeros.to(add_dtype)[g_idx])
+    intweight = intweight.to(div_dtype)
+    intweight.div_(scales.to(div_dtype)[g_idx])
+    # negative levels wrap around like an int32 -> uint32 cast
+    return intweight.round_().to(torch.int32).numpy().view(np.uint32)
+
+
+def pack_rows(values: np.ndarray, bits: int) -> np.ndarray:
+    """
+    Pack every 32 rows of the uint32 array `values` into `bits` int32 rows, `bits` bits per value.
+
+    The 32 values of a block form one little-endian stream of `32 * bits` bits, so with 3 bits a value may straddle
+    two words. Trailing rows that do not fill a block are dropped.
+    """
+    if bits not in SUPPORTED_PACK_BITS:
+        raise NotImplementedError("Only 2,3,4,8 bits are supported.")
+
+    blocks = values[: values.shape[0] // 32 * 32].reshape(-1, 32, *values.shape[1:])
+    packed = np.zeros((blocks.shape[0], bits, *values.shape[1:]), dtype=np.uint32)
+    for j in range(32):
+        word, shift = divmod(j * bits, 32)
+        packed[:, word] |= blocks[:, j] << np.uint32(shift)
+        if shift + bits > 32:
+            # the high bits continue at the start of the next word
+            packed[:, word + 1] |= (blocks[:, j] >> np.uint32(32 - shift)) & np.uint32((1 << (shift + bits - 32)) - 1)
+
+    return packed.reshape(-1, *values.shape[1:]).view(np.int32)
+
+
+def pack_columns(values: np.ndarray, bits: int) -> np.ndarray:
+    """`pack_rows()` along the columns of the 2D uint32 array `values`."""
+    return np.ascontiguousarray(pack_rows(values.T, bits).T)
+
+
+# the offset between gptq v1 and v2 qzeros: a packed word with every zero point set to 1. For 3 bits the pattern
+# repeats every 3 words, but words 0 and 2 are swapped against the pack_rows() layout, whose +1 pattern is
+# [0x49249249, 0x92492492, 0x24924924]. This order is kept on purpose: it is what v1 checkpoints have always been
+# written and read with, so the 3-bit offset is not exactly +1 per zero point.
+_QZEROS_ONES = {
+    2: [0b01010101010101010101010101010101],
+    3: [0b00100100100100100100100100100100, 0b10010010010010010010010010010010, 0b01001001001001001001001001001001],
+    4: [0b00010001000100010001000100010001],
+    8: [0b00000001000000010000000100000001],
+}
+
+
+def qzeros_ones(bits: int, columns: int, device: torch.device = None) -> torch.Tensor:
+    """The int32 row of `columns` packed qzeros words that adds or subtracts 1 from every zero point."""
+    if bits not in SUPPORTED_PACK_BITS:
+        raise NotImplementedError("Only 2,3,4,8 bits are supported.")
+
+    words = np.array(_QZEROS_ONES[bits], dtype=np.uint32).view(np.int32)
+    return torch.from_numpy(np.resize(words, columns)).to(device)
+
+
+def convert_qzeros_v2_to_v1(qzeros: torch.Tensor, bits: int) -> torch.Tensor:
+    """
+    Returns a gptq v1 copy of the packed gptq v2 `qzeros`, which stores every zero point minus 1.
+
+    sym=False has underflow probability of ~<=13% during testing. No underflow possible for sym=True.
+    """
+    return qzeros - qzeros_ones(bits, qzeros.shape[-1], qzeros.device)
+
+
+def convert_qzeros_v1_to_v2(qzeros: torch.Tensor, bits: int) -> torch.Tensor:
+    """
+    Returns a gptq v2 copy of the packed gptq v1 `qzeros`, the inverse of `convert_qzeros_v2_to_v1()`.
+
+    v1 checkpoint format used to do `qzeros = qzeros -= 1` before serialization, thus the additions here do not
+    overflow. v1 checkpoint format with sym=False saved via convert_gptq_v2_to_v1_format() will overflow ~<=13% based
+    on testing.
+    """
+    return qzeros + qzeros_ones(bits, qzeros.shape[-1], qzeros.device)
+
+
+__all__ = ["SUPPORTED_PACK_BITS", "quantize_weight", "pack_rows", "pack_columns", "qzeros_ones", "convert_qzeros_v2_to_v1",
+           "convert_qzeros_v1_to_v2"]
@@ -0,0 +1,109 @@
+import queue
+import threading
+import time
+from typing import Any, Callable
+
+import torch
+
+
+class BatchPrefetcher:
+    """
+    Iterate `load(j)` for `j` in `range(count)` with every tensor moved to `device`, up to `depth` batches ahead.
+
+    A background thread gathers each batch, pins its host tensors and issues the copies on a side cuda
+    stream. The consumer only makes its current stream wait on the copy event of the batch it takes, so
+    host-to-device transfers of the next batches overlap the forward of the current one.
+    `wait_time` is the time the consumer spent blocked on the thread, `bytes` the bytes moved.
+    """
+
+    def __init__(self, load: Callable[[int], Any], count: int, device: torch.device, depth: int = 2):
+        self.load = load
+        self.count = count
+        self.device = device
+        self.cuda = device.type == "cuda"
+        self.stream = torch.cuda.Stream(device) if self.cuda else None
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.bytes = 0
+        self.wait_time = 0.0
+        # inference mode is thread local, tensors created by the thread must match the consumer's
+        self.inference_mode = torch.is_inference_mode_enabled()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _copy(self, obj):
+        if isinstance(obj, torch.Tensor):
+            if obj.device == self.device:
+                return obj
+            self.bytes += obj.numel() * obj.element_size()
+            if self.cuda and obj.device.type == "cpu":
+                if not obj.is_pinned():
+                    obj = obj.pin_memory()
+                return obj.to(self.device, non_blocking=True)
+            return obj.to(self.device)
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._copy(e) for e in obj)
+        elif isinstance(obj, dict):
+            return {k: self._copy(v) for k, v in obj.items()}
+        return obj
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        try:
+            with torch.inference_mode(self.inference_mode):
+                for j in range(self.count):
+                    if self.stop.is_set():
+                        return
+                    if self.cuda:
+                        with torch.cuda.stream(self.stream):
+                            batch = self._copy(self.load(j))
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        batch = self._copy(self.load(j))
+                        event = None
+                    self._put((batch, event, None))
+        except BaseException as e:
+            self._put((None, None, e))
+
+    def _record_stream(self, obj, stream):
+        # memory allocated on the side stream must not be reused before the consumer stream is done with it
+        if isinstance(obj, torch.Tensor):
+            if obj.device == self.device:
+                obj.record_stream(stream)
+        elif isinstance(obj, (list, tuple)):
+            for e in obj:
+                self._record_stream(e, stream)
+        elif isinstance(obj, dict):
+            for e in obj.values():
+                self._record_stream(e, stream)
+
+    def __iter__(self):
+        try:
+            for _ in range(self.count):
+                tick = time.perf_counter()
+                batch, event, error = self.queue.get()
+                self.wait_time += time.perf_counter() - tick
+                if error is not None:
+                    raise error
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    self._record_stream(batch, stream)
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+
+__all__ = ["BatchPrefetcher"]
@@ -0,0 +1,239 @@
+import json
+import os
+import re
+import struct
+from logging import getLogger
+from typing import BinaryIO, Callable, Dict, Optional, Union
+
+import torch
+import torch.nn as nn
+from accelerate.utils import convert_file_size_to_int, set_module_tensor_to_device
+from safetensors import safe_open
+from safetensors.torch import save_file as safe_save
+
+from ..models._const import CPU
+from .model import get_checkpoints
+
+
+logger = getLogger(__name__)
+
+META = torch.device("meta")
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+class LayerStreamer:
+    """
+    Materializes parts of a model built on the meta device from its safetensors checkpoint, one module at a time.
+
+    Only the tensors of the requested module are read, so a model larger than host RAM can be quantized
+    layer by layer.
+    """
+
+    def __init__(self, model_name_or_path: str, dtype: torch.dtype, **cached_file_kwargs):
+        is_sharded, resolved_file, _ = get_checkpoints(
+            model_name_or_path, extensions=[".safetensors"], possible_model_basenames=["model"], **cached_file_kwargs
+        )
+        if is_sharded:
+            with open(resolved_file, "r", encoding="utf-8") as f:
+                weight_map = json.load(f)["weight_map"]
+            folder = os.path.dirname(resolved_file)
+            self.weight_map = {k: os.path.join(folder, v) for k, v in weight_map.items()}
+        else:
+            with safe_open(resolved_file, framework="pt") as f:
+                self.weight_map = dict.fromkeys(f.keys(), resolved_file)
+        self.dtype = dtype
+
+    def materialize(self, module: nn.Module, prefix: str = "", device: torch.device = CPU, skip: Optional[str] = None):
+        """Load every meta parameter/buffer of `module` found in the checkpoint under `prefix`, except names under `skip`."""
+        by_file = {}
+        for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+            full_name = prefix + name
+            if tensor.device != META or full_name not in self.weight_map:
+                continue
+            if skip is not None and full_name.startswith(skip):
+                continue
+            by_file.setdefault(self.weight_map[full_name], []).append(name)
+
+        for file, names in by_file.items():
+            with safe_open(file, framework="pt", device=str(device)) as f:
+                for name in names:
+                    value = f.get_tensor(prefix + name)
+                    if value.is_floating_point():
+                        value = value.to(self.dtype)
+                    set_module_tensor_to_device(module, name, device, value=value)
+        return module
+
+    @staticmethod
+    def free(module: nn.Module):
+        """Drop the storage of every parameter and buffer of `module`."""
+        return module.to(META)
+
+
+class ShardWriter:
+    """
+    Writes a state dict piece by piece into safetensors shards of at most `max_shard_size`.
+
+    Pieces are buffered until the next one would overflow the shard. `finish()` names the files like
+    `save_quantized()` does and writes the index, a single shard is saved without one. Like
+    `save_quantized()`, the shards and index of a previous save under `model_base_name` are deleted
+    before the first shard is written.
+    """
+
+    def __init__(self, save_dir: str, model_base_name: str = "model", max_shard_size: Optional[Union[int, str]] = "4GB"):
+        os.makedirs(save_dir, exist_ok=True)
+        self.save_dir = save_dir
+        self.model_base_name = model_base_name
+        self.max_shard_size = convert_file_size_to_int(max_shard_size) if max_shard_size is not None else None
+        self.pending = {}
+        self.pending_size = 0
+        self.shards = []
+        self.total_size = 0
+
+    def add(self, state_dict: Dict[str, torch.Tensor]):
+        size = sum(t.numel() * t.element_size() for t in state_dict.values())
+        if self.max_shard_size is not None and self.pending and self.pending_size + size > self.max_shard_size:
+            self.flush()
+        self.pending.update({k: v.to(CPU).contiguous() for k, v in state_dict.items()})
+        self.pending_size += size
+        self.total_size += size
+
+    def remove_previous(self):
+        # single file, index, shards and the temporary shards of an interrupted write
+        reg = re.compile(
+            rf"{re.escape(self.model_base_name)}"
+            r"(\.safetensors|\.safetensors\.index\.json|-\d{5}-of-\d{5}\.safetensors|-\d{5}\.safetensors\.tmp)"
+        )
+        for filename in os.listdir(self.save_dir):
+            full_filename = os.path.join(self.save_dir, filename)
+            if os.path.isfile(full_filename) and reg.fullmatch(filename) is not None:
+                os.remove(full_filename)
+
+    def flush(self):
+        if not self.pending:
+            return
+        if not self.shards:
+            self.remove_previous()
+        file = os.path.join(self.save_dir, f"{self.model_base_name}-{len(self.shards) + 1:05d}.safetensors.tmp")
+        safe_save(self.pending, file, {"format": "pt"})
+        self.shards.append((file, list(self.pending)))
+        self.pending = {}
+        self.pending_size = 0
+
+    def finish(self):
+        self.flush()
+        if len(self.shards) == 1:
+            os.replace(self.shards[0][0], os.path.join(self.save_dir, f"{self.model_base_name}.safetensors"))
+            return
+
+        weight_map = {}
+        for n, (file, keys) in enumerate(self.shards):
+            shard_file = f"{self.model_base_name}-{n + 1:05d}-of-{len(self.shards):05d}.safetensors"
+            os.replace(file, os.path.join(self.save_dir, shard_file))
+            weight_map.update(dict.fromkeys(keys, shard_file))
+
+        index = {"metadata": {"total_size": self.total_size}, "weight_map": weight_map}
+        with open(os.path.join(self.save_dir, f"{self.model_base_name}.safetensors.index.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps(index, indent=2, sort_keys=True) + "\n")
+        logger.info(f"Saved {len(self.shards)} shards to {self.save_dir}")
+
+
+class StagingBuffer:
+    """
+    Copies device tensors to a file through two reusable pinned host buffers of `chunk_size` bytes.
+
+    The next chunk is copied from the device while the previous one is written, so a tensor never needs a
+    host copy of its own.
+    """
+
+    def __init__(self, chunk_size: int = 64 * 1024 ** 2):
+        self.chunk_size = chunk_size
+        self.buffers = None
+
+    def write(self, f: BinaryIO, data: torch.Tensor):
+        """Write the bytes of the contiguous 1D uint8 cuda tensor `data` to `f`."""
+        if self.buffers is None:
+            self.buffers = [torch.empty(self.chunk_size, dtype=torch.uint8, pin_memory=True) for _ in range(2)]
+
+        with torch.cuda.device(data.device):
+            pending = None
+            for n, start in enumerate(range(0, data.numel(), self.chunk_size)):
+                chunk = self.buffers[n % 2][: min(self.chunk_size, data.numel() - start)]
+                chunk.copy_(data[start: start + chunk.numel()], non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                # the other buffer was copied into one step ago
+                if pending is not None:
+                    pending[1].synchronize()
+                    f.write(pending[0].numpy())
+                pending = (chunk, event)
+            if pending is not None:
+                pending[1].synchronize()
+                f.write(pending[0].numpy())
+
+
+def write_safetensors(
+    file: str,
+    tensors: Dict[str, torch.Tensor],
+    metadata: Optional[Dict[str, str]] = None,
+    staging: Optional[StagingBuffer] = None,
+    transform: Optional[Callable[[str, torch.Tensor], torch.Tensor]] = None,
+):
+    """
+    Save `tensors` as a safetensors file, writing each one straight from wherever it lives.
+
+    The header is built from shapes and dtypes alone. Cpu tensors are written from their own memory, cuda tensors go
+    through `staging`, so saving never holds more than one non-contiguous tensor's copy in memory.
+
+    `transform(name, tensor)` is applied to each tensor right before it is written and must keep its shape and dtype,
+    so a converted copy only lives until its bytes are on disk.
+    """
+    # widest dtypes first keeps every tensor aligned to its element size
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+
+    header = {"__metadata__": metadata} if metadata else {}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        if tensor.dtype not in SAFETENSORS_DTYPES:
+            raise ValueError(f"Tensor {name} has dtype {tensor.dtype}, which cannot be saved as safetensors.")
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": SAFETENSORS_DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # the data starts 8 byte aligned
+    header += b" " * (-len(header) % 8)
+
+    tmp = f"{file}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in names:
+            tensor = tensors[name].detach()
+            if transform is not None:
+                tensor = transform(name, tensor)
+                if tensor.shape != tensors[name].shape or tensor.dtype != tensors[name].dtype:
+                    raise ValueError(f"Transform of tensor {name} changed its shape or dtype.")
+            data = tensor.contiguous().view(-1).view(torch.uint8)
+            if data.device.type == "cuda":
+                if staging is None:
+                    staging = StagingBuffer()
+                staging.write(f, data)
+            else:
+                f.write(data.to(CPU).numpy())
+    os.replace(tmp, file)
+
+
+__all__ = ["LayerStreamer", "ShardWriter", "StagingBuffer", "write_safetensors"]
@@ -0,0 +1,99 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.nn as nn
+
+from .model import get_device, move_to
+
+
+class StageTimer:
+    """
+    Accumulates wall time, token counts and bytes moved per quantization stage.
+
+    Stages on cuda devices are timed with cuda events so the hot path never waits on the device,
+    events are resolved once per `flush()`. Every entry passed to `emit()` is appended to `log_file`
+    as one json line and handed to `callback`.
+    """
+
+    def __init__(self, log_file: Optional[str] = None, callback: Optional[Callable[[Dict], None]] = None):
+        self.log_file = log_file
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.tokens = defaultdict(int)
+        self.bytes = defaultdict(int)
+        # (stage, start event, end event) not resolved yet
+        self.events = []
+
+    @contextmanager
+    def stage(self, name: str, device: Optional[torch.device] = None):
+        if device is not None and device.type == "cuda":
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record(torch.cuda.current_stream(device))
+            try:
+                yield
+            finally:
+                # the layer-0 capture forward ends by raising
+                end.record(torch.cuda.current_stream(device))
+                self.events.append((name, start, end))
+        else:
+            tick = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.times[name] += time.perf_counter() - tick
+
+    def add(self, name: str, seconds: float = 0.0, tokens: int = 0, bytes: int = 0):
+        self.times[name] += seconds
+        self.tokens[name] += tokens
+        self.bytes[name] += bytes
+
+    def move(self, obj, device: torch.device):
+        """`move_to()` that accounts the copy to the `move` stage."""
+        if obj is None or get_device(obj) == device:
+            return obj
+
+        if isinstance(obj, nn.Module):
+            size = sum(t.numel() * t.element_size() for t in list(obj.parameters()) + list(obj.buffers()))
+        else:
+            size = obj.numel() * obj.element_size()
+
+        tick = time.perf_counter()
+        obj = move_to(obj, device)
+        self.add("move", seconds=time.perf_counter() - tick, bytes=size)
+        return obj
+
+    def flush(self, layer: Optional[int] = None) -> Dict:
+        """Return the stats gathered since the last flush as a quant_log entry and reset."""
+        for name, start, end in self.events:
+            end.synchronize()
+            self.times[name] += start.elapsed_time(end) / 1000
+
+        stages = {}
+        for name in self.times.keys() | self.tokens.keys() | self.bytes.keys():
+            stage = {"time": round(self.times[name], 4)}
+            if self.tokens[name]:
+                stage["tokens"] = self.tokens[name]
+            if self.bytes[name]:
+                stage["bytes"] = self.bytes[name]
+            stages[name] = stage
+
+        self.reset()
+        return {"layer": layer, "stages": dict(sorted(stages.items()))}
+
+    def emit(self, entry: Dict):
+        if self.log_file:
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        if self.callback is not None:
+            self.callback(entry)
+
+
+__all__ = ["StageTimer"]
@@ -0,0 +1,67 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+import torch.nn as nn  # noqa: E402
+from gptqmodel.utils.capture_cache import CaptureCache  # noqa: E402
+from transformers import LlamaConfig  # noqa: E402
+
+
+class TestCaptureCache(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = nn.Module()
+        self.model.config = LlamaConfig(vocab_size=128, hidden_size=32)
+        self.embed = nn.Embedding(128, 32).to(torch.bfloat16)
+        self.dataset = [
+            {"input_ids": [1, 2, 3], "attention_mask": [1, 1, 1]},
+            {"input_ids": torch.tensor([4, 5]), "attention_mask": torch.tensor([1, 1])},
+        ]
+        self.options = {"batch_size": 1}
+
+    def fingerprint(self, dataset=None, options=None):
+        return CaptureCache.compute_fingerprint(
+            self.model, [self.embed], dataset or self.dataset, options or self.options
+        )
+
+    def test_fingerprint(self):
+        fingerprint = self.fingerprint()
+        self.assertEqual(fingerprint, self.fingerprint())
+
+        # lists and tensors of the same token ids are the same data
+        self.assertEqual(
+            fingerprint,
+            self.fingerprint(dataset=[{k: torch.tensor(v) for k, v in e.items()} for e in self.dataset]),
+        )
+
+        self.assertNotEqual(fingerprint, self.fingerprint(options={"batch_size": 2}))
+        self.assertNotEqual(fingerprint, self.fingerprint(dataset=self.dataset[:1]))
+        # sample boundaries matter, not just the token stream
+        self.assertNotEqual(
+            fingerprint,
+            self.fingerprint(dataset=[{"input_ids": [1, 2, 3, 4, 5], "attention_mask": [1, 1, 1, 1, 1]}]),
+        )
+
+        with torch.no_grad():
+            self.embed.weight[0, 0] += 1
+        self.assertNotEqual(fingerprint, self.fingerprint())
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = CaptureCache(tmp_dir, self.fingerprint())
+            self.assertFalse(cache.exists())
+
+            layer_inputs = [[torch.randn(1, 3, 32)], [torch.randn(1, 2, 32)]]
+            cache.save({"layer_inputs": layer_inputs, "token_masks": [None, None]})
+            self.assertTrue(cache.exists())
+
+            captured = CaptureCache(tmp_dir, self.fingerprint()).load()
+            self.assertEqual(captured["token_masks"], [None, None])
+            for inp, restored in zip(layer_inputs, captured["layer_inputs"]):
+                self.assertTrue(torch.equal(inp[0], restored[0]))
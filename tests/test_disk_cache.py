@@ -0,0 +1,76 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import pickle  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.utils.disk_cache import DiskCache  # noqa: E402
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_spill(self):
+        items = [
+            [torch.randn(2, 16, 32, dtype=torch.bfloat16)],
+            torch.ones(2, 16, dtype=torch.bool),
+            None,
+            [torch.randn(1, 8, 32), torch.arange(8)],
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # room for the first item only
+            cache = DiskCache(tmp_dir, max_memory=2 * 16 * 32 * 2)
+            store = cache.list()
+            for item in items:
+                store.append(item)
+
+            self.assertEqual(len(store), len(items))
+            self.assertEqual(cache.resident, 2 * 16 * 32 * 2)
+            self.assertEqual(store.size, 16 * 2 + (8 * 32 * 4 + 8 * 8))
+
+            for item, stored in zip(items, store):
+                if isinstance(item, list):
+                    self.assertEqual(len(item), len(stored))
+                    for t, s in zip(item, stored):
+                        self.assertEqual(s.dtype, t.dtype)
+                        self.assertTrue(torch.equal(s, t))
+                elif item is None:
+                    self.assertIsNone(stored)
+                else:
+                    self.assertTrue(torch.equal(stored, item))
+
+            # checkpoints pickle the store as a plain list
+            restored = pickle.loads(pickle.dumps(store))
+            self.assertIsInstance(restored, list)
+            self.assertTrue(torch.equal(restored[3][0], items[3][0]))
+
+            store.close()
+            self.assertEqual(cache.resident, 0)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_budget_threads(self):
+        tensor = torch.ones(256)
+        nbytes = 256 * 4
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # room for 10 tensors, appended to from 8 threads at once
+            cache = DiskCache(tmp_dir, max_memory=10 * nbytes)
+            stores = [cache.list() for _ in range(8)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [
+                    executor.submit(lambda store: [store.append(tensor) for _ in range(50)], store) for store in stores
+                ]
+            for future in futures:
+                future.result()
+            self.assertEqual(cache.resident, 10 * nbytes)
+            self.assertEqual(sum(store.resident for store in stores), 10 * nbytes)
+            self.assertTrue(all(torch.equal(t, tensor) for store in stores for t in store))
+
+            for store in stores:
+                store.close()
+            self.assertEqual(cache.resident, 0)
@@ -0,0 +1,192 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import copy  # noqa: E402
+import unittest  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+
+import torch  # noqa: E402
+import torch.nn as nn  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+
+
+class TestGPTQ(unittest.TestCase):
+    DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.inputs = [torch.randn(2, 64, 256, device=self.DEVICE) for _ in range(4)]
+
+    def _gptq(self, layer):
+        gptq = GPTQ(layer)
+        gptq.quantizer.configure(4, perchannel=True, sym=False, mse=False)
+        return gptq
+
+    def _quantize(self, gptq, **kwargs):
+        kwargs.setdefault("group_size", 128)
+        kwargs.setdefault("actorder", True)
+        scale, zero, g_idx, _, avg_loss = gptq.fasterquant(**kwargs)
+        return scale, zero, g_idx, gptq.layer.weight.data.clone(), avg_loss
+
+    def assert_quantized_equal(self, a, b, atol=1e-6):
+        for x, y in zip(a[:4], b[:4]):
+            self.assertTrue(torch.allclose(x.float(), y.float(), atol=atol))
+        self.assertAlmostEqual(a[4], b[4], places=4)
+
+    def test_shared_hessian(self):
+        layers = [nn.Linear(256, 128, bias=False).to(self.DEVICE) for _ in range(3)]
+        reference_layers = copy.deepcopy(layers)
+
+        reference = [self._gptq(layer) for layer in reference_layers]
+        for inp in self.inputs:
+            for gptq in reference:
+                gptq.add_batch(inp, None)
+
+        shared = [self._gptq(layer) for layer in layers]
+        for gptq in shared[1:]:
+            gptq.share_hessian(shared[0])
+        for inp in self.inputs:
+            for gptq in shared:
+                gptq.add_batch(inp, None)
+
+        # only the owner accumulates
+        self.assertIsNotNone(shared[0].H)
+        self.assertTrue(all(gptq.H is None for gptq in shared[1:]))
+
+        # sharers quantize first so the owner's Hessian must survive until every sibling is done
+        for ref, gptq in zip(reversed(reference), reversed(shared)):
+            self.assert_quantized_equal(self._quantize(ref), self._quantize(gptq))
+            ref.free()
+            gptq.free()
+
+        self.assertIsNone(shared[0].hinv)
+
+    def test_vectorized_solver(self):
+        wide_inputs = [torch.randn(2, 512, 1024, device=self.DEVICE) for _ in range(2)]
+        for columns, inputs, kwargs in (
+            (256, self.inputs, {"group_size": 128, "actorder": True}),
+            (256, self.inputs, {"group_size": 32, "actorder": True, "static_groups": True}),
+            (256, self.inputs, {"group_size": 32, "actorder": False}),
+            (256, self.inputs, {"group_size": -1, "actorder": False}),
+            # wide enough for a float reordering of the error updates to flip roundings
+            (1024, wide_inputs, {"group_size": 128, "actorder": True}),
+            (1024, wide_inputs, {"group_size": 32, "actorder": False}),
+        ):
+            layer = nn.Linear(columns, 512, bias=False).to(self.DEVICE)
+            results = []
+            for vectorized in (False, True):
+                gptq = self._gptq(copy.deepcopy(layer))
+                for inp in inputs:
+                    gptq.add_batch(inp, None)
+                results.append(self._quantize(gptq, vectorized=vectorized, **kwargs))
+                gptq.free()
+
+            # scales, zeros, g_idx, Q and the loss are bit identical to the per-column loop
+            for x, y in zip(*results):
+                if isinstance(x, torch.Tensor):
+                    self.assertTrue(torch.equal(x, y), (columns, kwargs))
+                else:
+                    self.assertEqual(x, y, (columns, kwargs))
+
+    def test_mse_chunking(self):
+        from gptqmodel.quantization.quantizer import Quantizer
+
+        W = torch.randn(128, 256, device=self.DEVICE)
+        params = []
+        # a 1 byte budget evaluates one shrink candidate at a time
+        for mse_chunk_bytes in (1, 1024**2, 256 * 1024**2):
+            quantizer = Quantizer()
+            quantizer.configure(4, perchannel=True, sym=False, mse=True, mse_chunk_bytes=mse_chunk_bytes)
+            quantizer.find_params(W, weight=True)
+            params.append((quantizer.scale, quantizer.zero))
+
+        for scale, zero in params[1:]:
+            self.assertTrue(torch.equal(scale, params[0][0]))
+            self.assertTrue(torch.equal(zero, params[0][1]))
+
+    def test_find_group_params(self):
+        from gptqmodel.quantization.quantizer import Quantizer
+
+        W = torch.randn(64, 200, device=self.DEVICE)
+        quantizer = Quantizer()
+        quantizer.configure(4, perchannel=True, sym=False, mse=False)
+        scale, zero = quantizer.find_group_params(W, 32)
+        self.assertEqual(scale.shape, (64, 7))
+
+        # last group is partial
+        for g, i in enumerate(range(0, 200, 32)):
+            quantizer.find_params(W[:, i : (i + 32)], weight=True)
+            self.assertTrue(torch.equal(quantizer.scale.flatten(), scale[:, g]))
+            self.assertTrue(torch.equal(quantizer.zero.flatten(), zero[:, g]))
+
+    def test_chunked_hessian(self):
+        layer = nn.Linear(256, 128, bias=False).to(self.DEVICE)
+        reference = self._gptq(copy.deepcopy(layer))
+        chunked = self._gptq(layer)
+        chunked.hessian_chunk_size = 24
+        # several bands so only the blocks above the diagonal are accumulated
+        chunked.hessian_tile = 96
+
+        for inp in self.inputs:
+            reference.add_batch(inp, None)
+            chunked.add_batch(inp, None)
+
+        self.assertTrue(chunked.hessian_triu)
+        self.assertTrue(torch.allclose(reference.H, chunked.symmetric_hessian(), atol=1e-5))
+        self.assert_quantized_equal(self._quantize(reference), self._quantize(chunked), atol=1e-4)
+
+    def test_padded_batch(self):
+        layer = nn.Linear(256, 128, bias=False).to(self.DEVICE)
+        reference = self._gptq(copy.deepcopy(layer))
+        padded = self._gptq(layer)
+
+        lengths = [64, 40, 17, 9]
+        samples = [torch.randn(1, length, 256, device=self.DEVICE) for length in lengths]
+        for sample in samples:
+            reference.add_batch(sample, None)
+
+        # right padded batch of all samples, as produced by collate_data
+        batch = torch.randn(len(lengths), max(lengths), 256, device=self.DEVICE)
+        token_mask = torch.zeros(batch.shape[:-1], dtype=torch.bool, device=self.DEVICE)
+        for k, (sample, length) in enumerate(zip(samples, lengths)):
+            batch[k, :length] = sample[0]
+            token_mask[k, :length] = True
+        padded.add_batch(batch, None, token_mask)
+
+        self.assertEqual(padded.nsamples, reference.nsamples)
+        self.assertTrue(torch.allclose(reference.H, padded.H, atol=1e-5))
+
+    def test_concurrent_shared_hessian(self):
+        layers = [nn.Linear(256, 128, bias=False).to(self.DEVICE) for _ in range(4)]
+        reference_layers = copy.deepcopy(layers)
+
+        reference = [self._gptq(layer) for layer in reference_layers]
+        shared = [self._gptq(layer) for layer in layers]
+        for gptq in shared[1:]:
+            gptq.share_hessian(shared[0])
+        for inp in self.inputs:
+            for gptq in reference + shared:
+                gptq.add_batch(inp, None)
+
+        # siblings race to compute the shared inverse
+        with ThreadPoolExecutor(max_workers=len(shared)) as executor:
+            results = list(executor.map(self._quantize, shared))
+
+        for ref, result in zip(reference, results):
+            self.assert_quantized_equal(self._quantize(ref), result)
+
+    def test_no_tokens(self):
+        # an expert nothing was routed to, its hook may still fire with an empty slice
+        layer = nn.Linear(256, 128, bias=False).to(self.DEVICE)
+        weight = layer.weight.data.clone()
+        gptq = self._gptq(layer)
+        gptq.add_batch(torch.randn(0, 256, device=self.DEVICE), None)
+        self.assertEqual(gptq.tokens, 0)
+
+        self._quantize(gptq, actorder=False)
+        # quantized round-to-nearest instead of zeroed as dead columns
+        self.assertFalse((layer.weight.data == 0).all(dim=0).any())
+        self.assertLess((layer.weight.data - weight).abs().max().item(), weight.abs().max().item() / 4)
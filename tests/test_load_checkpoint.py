@@ -0,0 +1,86 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+import torch.nn as nn  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.utils.model import (convert_gptq_v1_to_v2_format, gptq_v2_qzeros_transform,  # noqa: E402
+                                   load_checkpoint_with_transform)
+from gptqmodel.utils.stream import ShardWriter  # noqa: E402
+from safetensors.torch import load_file, save_file  # noqa: E402
+
+
+class QLinear(nn.Module):
+    """Stands in for a QuantLinear, only its buffers are loaded."""
+
+    def __init__(self, bits):
+        super().__init__()
+        self.register_buffer("qzeros", torch.zeros(2, 3 * bits, dtype=torch.int32))
+        self.register_buffer("scales", torch.zeros(2, 96, dtype=torch.float16))
+
+
+class TestLoadCheckpoint(unittest.TestCase):
+    QLINEAR_NAMES = ["layers.0.proj", "layers.1.proj"]
+
+    def model(self, bits):
+        model = nn.Module()
+        model.layers = nn.ModuleList(nn.Module() for _ in range(2))
+        for layer in model.layers:
+            layer.proj = QLinear(bits)
+        model.head = nn.Linear(8, 8)
+        return model
+
+    def assert_loaded(self, checkpoint, state_dict, bits):
+        quantize_config = QuantizeConfig(bits=bits)
+
+        # the v1 -> v2 conversion of the whole loaded model it replaces
+        expected = self.model(bits)
+        expected.load_state_dict(state_dict)
+        convert_gptq_v1_to_v2_format(expected, quantize_config=quantize_config, qlinear_kernel=QLinear)
+
+        model = load_checkpoint_with_transform(
+            self.model(bits),
+            checkpoint,
+            device_map={"": "cpu"},
+            dtype=torch.float32,
+            transform=gptq_v2_qzeros_transform(self.QLINEAR_NAMES, quantize_config=quantize_config),
+        )
+        for name, tensor in expected.state_dict().items():
+            loaded = model.state_dict()[name]
+            # only floating point tensors take the load dtype
+            self.assertEqual(loaded.dtype, torch.int32 if name.endswith("qzeros") else torch.float32, name)
+            self.assertTrue(torch.equal(loaded, tensor.to(loaded.dtype)), name)
+
+    def test_load_v1(self):
+        torch.manual_seed(0)
+        for bits in [2, 3, 4, 8]:
+            state_dict = {
+                name: tensor.clone() for name, tensor in self.model(bits).state_dict().items()
+            }
+            for name in self.QLINEAR_NAMES:
+                state_dict[f"{name}.qzeros"] = torch.randint(-2**31, 2**31 - 1, (2, 3 * bits), dtype=torch.int32)
+                state_dict[f"{name}.scales"] = torch.rand(2, 96, dtype=torch.float16)
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                file = os.path.join(tmp_dir, "model.safetensors")
+                save_file(state_dict, file, {"format": "pt"})
+                self.assert_loaded(file, state_dict, bits)
+
+                sharded_dir = os.path.join(tmp_dir, "sharded")
+                writer = ShardWriter(sharded_dir, max_shard_size=200)
+                for name, tensor in state_dict.items():
+                    writer.add({name: tensor})
+                writer.finish()
+                index = os.path.join(sharded_dir, "model.safetensors.index.json")
+                self.assertTrue(os.path.isfile(index))
+                self.assert_loaded(index, state_dict, bits)
+
+                # the checkpoint itself is left as written
+                saved = load_file(file)
+                self.assertTrue(all(torch.equal(saved[name], tensor) for name, tensor in state_dict.items()))
@@ -0,0 +1,90 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+from gptqmodel.utils.pack import (convert_qzeros_v1_to_v2, convert_qzeros_v2_to_v1, pack_columns, pack_rows,  # noqa: E402
+                                  quantize_weight)
+
+
+def reference_pack_rows(values, bits):
+    # one value at a time into a 32 * bits bit little-endian stream per block of 32 rows
+    packed = np.zeros((values.shape[0] // 32 * bits, values.shape[1]), dtype=np.uint64)
+    for row in range(values.shape[0]):
+        block, j = divmod(row, 32)
+        for bit in range(bits):
+            word, shift = divmod(j * bits + bit, 32)
+            packed[block * bits + word] |= ((values[row].astype(np.uint64) >> bit) & 1) << shift
+    return packed.astype(np.uint32).view(np.int32)
+
+
+class TestPack(unittest.TestCase):
+    def test_pack_rows(self):
+        rng = np.random.default_rng(0)
+        for bits in [2, 3, 4, 8]:
+            values = rng.integers(0, 2**bits, size=(64, 16)).astype(np.uint32)
+            packed = pack_rows(values, bits)
+            self.assertEqual(packed.dtype, np.int32)
+            self.assertEqual(packed.shape, (64 // 32 * bits, 16))
+            self.assertTrue(np.array_equal(packed, reference_pack_rows(values, bits)), bits)
+
+            columns = pack_columns(np.ascontiguousarray(values.T), bits)
+            self.assertTrue(columns.flags.c_contiguous)
+            self.assertTrue(np.array_equal(columns, packed.T), bits)
+
+        with self.assertRaises(NotImplementedError):
+            pack_rows(np.zeros((32, 1), dtype=np.uint32), 5)
+
+    def test_quantize_weight(self):
+        torch.manual_seed(0)
+        W = torch.randn(64, 128, dtype=torch.float16)
+        scales = torch.rand(4, 64) * 0.1 + 0.01
+        scale_zeros = torch.randint(0, 16, (4, 64)).float() * scales
+        g_idx = torch.randperm(128).int() // 32
+
+        # the per input feature loop QuantLinear.pack() used to run
+        expected = torch.cat(
+            [
+                torch.round((W[:, idx] + scale_zeros[g_idx[idx]]) / scales.half()[g_idx[idx]]).to(torch.int)[:, None]
+                for idx in range(128)
+            ],
+            dim=1,
+        ).t().contiguous().numpy().astype(np.uint32)
+
+        W_before = W.clone()
+        intweight = quantize_weight(W, scales.half(), scale_zeros, g_idx)
+        self.assertTrue(np.array_equal(intweight, expected))
+        self.assertTrue(torch.equal(W, W_before))
+
+    def test_convert_qzeros(self):
+        rng = np.random.default_rng(0)
+        for bits in [2, 4, 8]:
+            zeros = rng.integers(1, 2**bits, size=(96, 4)).astype(np.uint32)
+            qzeros = torch.from_numpy(pack_columns(np.ascontiguousarray(zeros.T), bits))
+
+            qzeros_before = qzeros.clone()
+            converted = convert_qzeros_v2_to_v1(qzeros, bits)
+            # every packed zero point is one lower, the input is left as is
+            expected = pack_columns(np.ascontiguousarray(zeros.T) - 1, bits)
+            self.assertTrue(np.array_equal(converted.numpy(), expected), bits)
+            self.assertTrue(torch.equal(qzeros, qzeros_before))
+            self.assertTrue(torch.equal(convert_qzeros_v1_to_v2(converted, bits), qzeros), bits)
+
+        with self.assertRaises(NotImplementedError):
+            convert_qzeros_v2_to_v1(torch.zeros(1, 1, dtype=torch.int32), 5)
+
+    def test_convert_qzeros_3bit(self):
+        # 32 zero points of 1 pack into the +1 pattern of pack_rows()
+        qzeros = torch.from_numpy(pack_columns(np.ones((1, 32), dtype=np.uint32), 3))
+        self.assertEqual(qzeros.numpy().view(np.uint32).tolist(), [[0x49249249, 0x92492492, 0x24924924]])
+
+        # v1 checkpoints have always used an offset with words 0 and 2 swapped, so the v1 bytes are not the zero
+        # points minus 1, but they convert back exactly
+        v1 = convert_qzeros_v2_to_v1(qzeros, 3)
+        self.assertEqual(v1.numpy().view(np.uint32).tolist(), [[0x24924925, 0x00000000, 0xDB6DB6DB]])
+        self.assertTrue(torch.equal(convert_qzeros_v1_to_v2(v1, 3), qzeros))
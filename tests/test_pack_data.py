@@ -0,0 +1,66 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.models.llama import LlamaGPTQ  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.utils.data import pack_data  # noqa: E402
+from transformers import LlamaConfig, LlamaForCausalLM  # noqa: E402
+
+
+class TestPackData(unittest.TestCase):
+    def test_pack(self):
+        blocks = [
+            {"input_ids": [[1, 2, 3]], "attention_mask": [[1, 1, 1]]},
+            # masked tokens are dropped, rows of one block are packed separately
+            {"input_ids": [[4, 5, 0], [6, 7, 8]], "attention_mask": [[1, 1, 0], [1, 1, 1]]},
+        ]
+        packed = pack_data(blocks, torch.float16)
+
+        self.assertEqual(packed["input_ids"].tolist(), [[1, 2, 3, 4, 5, 6, 7, 8]])
+        self.assertEqual(packed["position_ids"].tolist(), [[0, 1, 2, 0, 1, 0, 1, 2]])
+
+        mask = packed["attention_mask"]
+        self.assertEqual(mask.shape, (1, 1, 8, 8))
+        self.assertEqual(mask.dtype, torch.float16)
+        self.assertEqual(mask.max().item(), 0)
+
+        attend = (mask[0, 0] == 0).int()
+        expected = torch.zeros(8, 8, dtype=torch.int)
+        for start, end in [(0, 3), (3, 5), (5, 8)]:
+            expected[start:end, start:end] = torch.tril(torch.ones(end - start, end - start, dtype=torch.int))
+        self.assertTrue(torch.equal(attend, expected))
+
+    def test_pack_max_tokens(self):
+        config = LlamaConfig(
+            vocab_size=32, hidden_size=16, intermediate_size=32, num_hidden_layers=1, num_attention_heads=2,
+            pad_token_id=0, max_position_embeddings=131072,
+        )
+        model = LlamaForCausalLM(config)
+        model.seqlen = config.max_position_embeddings
+        gptq_model = LlamaGPTQ(model, quantized=False, quantize_config=QuantizeConfig())
+
+        def packed_lengths(lengths, **kwargs):
+            calibration_dataset = [{"input_ids": [1] * n, "attention_mask": [1] * n} for n in lengths]
+            batches = gptq_model._prepare_dataset_for_quantization(
+                calibration_dataset, batch_size=len(lengths), pack=True, **kwargs
+            )
+            for batch in batches:
+                tokens = batch["input_ids"].shape[1]
+                self.assertEqual(batch["attention_mask"].shape, (1, 1, tokens, tokens))
+            return [batch["input_ids"].shape[1] for batch in batches]
+
+        # a long context model is still packed within the default token budget
+        self.assertEqual(packed_lengths([1000, 1000, 1000]), [2000, 1000])
+        # a longer sample is packed on its own
+        self.assertEqual(packed_lengths([5, 4, 3, 2, 2], pack_max_tokens=6), [5, 4, 5, 2])
+        self.assertEqual(packed_lengths([9, 2], pack_max_tokens=6), [9, 2])
+
+        # the budget never exceeds the model's context length
+        model.seqlen = 8
+        self.assertEqual(packed_lengths([5, 4, 3, 2, 2], pack_max_tokens=2048), [5, 7, 4])
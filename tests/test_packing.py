@@ -15,6 +15,9 @@ import gptqmodel_marlin_cuda  # noqa: E402
 from gptqmodel.nn_modules.qlinear.qlinear_exllama import ExllamaQuantLinear  # noqa: E402
 from gptqmodel.nn_modules.qlinear.qlinear_marlin import MarlinQuantLinear, _get_perms, dequantize_weight  # noqa: E402
 from gptqmodel.nn_modules.qlinear.qlinear_tritonv2 import TritonV2QuantLinear  # noqa: E402
+from gptqmodel.quantization import FORMAT  # noqa: E402
+from gptqmodel.utils.backend import BACKEND  # noqa: E402
+from gptqmodel.utils.model import pack_model  # noqa: E402
 
 
 def gen_quant4(k, n, groupsize=-1):
@@ -163,3 +166,38 @@ class TestRepacking(unittest.TestCase):
 
         self.assertTrue(torch.allclose(weight_repacked, marlin_linear.B))
         self.assertTrue(torch.allclose(s, marlin_linear.s))
+
+    def test_pack_model_workers(self):
+        k = 256
+        n = 128
+        group_size = 32
+
+        model = nn.Sequential()
+        quantizers = {}
+        for i in range(6):
+            _, linear, s = gen_quant4(k, n, group_size)
+            model.add_module(str(i), linear)
+            zeros = torch.full((k // group_size, n), 8, dtype=torch.int32)
+            quantizers[str(i)] = (None, s.T, zeros.T, torch.arange(k, dtype=torch.int32) // group_size)
+
+        packed = []
+        for workers, threads_per_worker, low_memory in [(1, 1, False), (4, 2, False), (2, 1, True)]:
+            packed_model = copy.deepcopy(model)
+            pack_model(
+                model=packed_model,
+                quantizers=quantizers,
+                bits=4,
+                group_size=group_size,
+                backend=BACKEND.AUTO,
+                format=FORMAT.GPTQ,
+                workers=workers,
+                threads_per_worker=threads_per_worker,
+                low_memory=low_memory,
+            )
+            packed.append(packed_model.state_dict())
+
+        # packing layers concurrently or creating each QuantLinear just in time gives the same result
+        for state_dict in packed[1:]:
+            self.assertEqual(sorted(packed[0]), sorted(state_dict))
+            for name, tensor in packed[0].items():
+                self.assertTrue(torch.equal(tensor, state_dict[name]), name)
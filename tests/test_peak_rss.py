@@ -0,0 +1,26 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.utils.device import get_peak_rss, reset_peak_rss  # noqa: E402
+
+
+class TestPeakRss(unittest.TestCase):
+    def test_reset(self):
+        if not reset_peak_rss():
+            self.skipTest("the platform cannot reset the peak resident set size")
+
+        size = 512 * 1024 ** 2
+        tensor = torch.ones(size // 4)
+        del tensor
+        peak = get_peak_rss()
+        self.assertGreaterEqual(peak, size)
+
+        # a reset forgets the peak of everything before it
+        self.assertTrue(reset_peak_rss())
+        self.assertLess(get_peak_rss(), peak - size // 2)
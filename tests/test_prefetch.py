@@ -0,0 +1,60 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.utils.prefetch import BatchPrefetcher  # noqa: E402
+
+
+class TestBatchPrefetcher(unittest.TestCase):
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    def test_prefetch(self):
+        batches = [
+            (
+                [torch.randn(1, 8, 16)],
+                {
+                    "attention_mask": torch.ones(1, 8),
+                    "past_key_value": None,
+                    "position_embeddings": (torch.randn(8), torch.randn(8)),
+                },
+            )
+            for _ in range(5)
+        ]
+
+        prefetcher = BatchPrefetcher(batches.__getitem__, len(batches), self.DEVICE)
+        for (layer_input, kwargs), (host_input, host_kwargs) in zip(prefetcher, batches):
+            self.assertEqual(layer_input[0].device, self.DEVICE)
+            self.assertTrue(torch.equal(layer_input[0].cpu(), host_input[0]))
+            self.assertTrue(torch.equal(kwargs["attention_mask"].cpu(), host_kwargs["attention_mask"]))
+            self.assertIsNone(kwargs["past_key_value"])
+            self.assertIsInstance(kwargs["position_embeddings"], tuple)
+            self.assertEqual(kwargs["position_embeddings"][1].device, self.DEVICE)
+
+        if self.DEVICE.type == "cuda":
+            self.assertEqual(prefetcher.bytes, len(batches) * (8 * 16 + 8 + 8 + 8) * 4)
+        self.assertFalse(prefetcher.thread.is_alive())
+
+    def test_error(self):
+        def load(j):
+            if j == 2:
+                raise KeyError(j)
+            return [torch.zeros(1)]
+
+        loaded = []
+        with self.assertRaises(KeyError):
+            for batch in BatchPrefetcher(load, 4, self.DEVICE):
+                loaded.append(batch)
+        self.assertEqual(len(loaded), 2)
+
+    def test_early_stop(self):
+        prefetcher = BatchPrefetcher(lambda j: [torch.zeros(1)], 100, self.DEVICE, depth=1)
+        for j, _ in enumerate(prefetcher):
+            if j == 3:
+                break
+        prefetcher.close()
+        self.assertFalse(prefetcher.thread.is_alive())
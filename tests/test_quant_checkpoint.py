@@ -0,0 +1,81 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import json  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import FORMAT, QuantizeConfig  # noqa: E402
+from gptqmodel.utils.checkpoint import QuantizeCheckpoint  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestQuantCheckpoint(unittest.TestCase):
+    NATIVE_MODEL_ID = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(64))]
+
+        self.quantize_config = QuantizeConfig(
+            bits=4,
+            group_size=128,
+            format=FORMAT.GPTQ,
+        )
+
+    def quantize(self, **kwargs):
+        model = GPTQModel.from_pretrained(
+            self.NATIVE_MODEL_ID,
+            quantize_config=self.quantize_config,
+        )
+        return model, model.quantize(self.calibration_dataset, **kwargs)
+
+    def test_resume(self):
+        reference_model, (reference_log, reference_quantizers, *_) = self.quantize()
+
+        finished_layers = 3
+        save_layer = QuantizeCheckpoint.save_layer
+
+        def interrupted_save_layer(checkpoint, index, *args, **kwargs):
+            save_layer(checkpoint, index, *args, **kwargs)
+            if index == finished_layers - 1:
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            QuantizeCheckpoint.save_layer = interrupted_save_layer
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    self.quantize(checkpoint_dir=tmp_dir)
+            finally:
+                QuantizeCheckpoint.save_layer = save_layer
+
+            with open(os.path.join(tmp_dir, QuantizeCheckpoint.META_FILE)) as f:
+                self.assertEqual(json.load(f)["finished_layers"], finished_layers)
+
+            model, (quant_log, quantizers, *_) = self.quantize(resume_from=tmp_dir)
+
+        self.assertEqual(list(quantizers), list(reference_quantizers))
+        for name, (_, scale, zero, g_idx) in quantizers.items():
+            _, reference_scale, reference_zero, reference_g_idx = reference_quantizers[name]
+            self.assertTrue(torch.equal(scale.cpu(), reference_scale.cpu()))
+            self.assertTrue(torch.equal(zero.cpu(), reference_zero.cpu()))
+            self.assertTrue(torch.equal(g_idx.cpu(), reference_g_idx.cpu()))
+
+        # stage timing entries have no module
+        self.assertEqual(
+            [(stat["module"], stat["avg_loss"]) for stat in quant_log if "module" in stat],
+            [(stat["module"], stat["avg_loss"]) for stat in reference_log if "module" in stat],
+        )
+
+        state_dict = model.model.state_dict()
+        for name, tensor in reference_model.model.state_dict().items():
+            self.assertTrue(torch.equal(state_dict[name].cpu(), tensor.cpu()), name)
@@ -0,0 +1,89 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import FORMAT, QuantizeConfig  # noqa: E402
+from gptqmodel.utils import Perplexity  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestQuantFpInputs(unittest.TestCase):
+    NATIVE_MODEL_ID = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+    def calculate_avg_ppl(self, model, tokenizer):
+        ppl = Perplexity(
+            model=model,
+            tokenizer=tokenizer,
+            dataset_path="wikitext",
+            dataset_name="wikitext-2-raw-v1",
+            split="test",
+            text_column="text",
+        )
+
+        all = ppl.calculate(n_ctx=512, n_batch=512)
+
+        # average ppl
+        avg = sum(all) / len(all)
+
+        return avg
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+
+        if not self.tokenizer.pad_token_id:
+            self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(256))]
+
+    def quantized_ppl(self, **kwargs):
+        quantize_config = QuantizeConfig(
+            bits=4,
+            group_size=128,
+            format=FORMAT.GPTQ,
+        )
+
+        model = GPTQModel.from_pretrained(
+            self.NATIVE_MODEL_ID,
+            quantize_config=quantize_config,
+        )
+
+        model.pack(*model.quantize(self.calibration_dataset, **kwargs))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model.save_quantized(
+                tmp_dir,
+            )
+
+            del model
+
+            model = GPTQModel.from_quantized(
+                tmp_dir,
+                device_map="auto",
+            )
+
+            return self.calculate_avg_ppl(model, self.tokenizer)
+
+    def test_fp_layer_inputs(self):
+        sequential_ppl = self.quantized_ppl()
+
+        devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        fp_inputs_ppl = self.quantized_ppl(
+            fp_layer_inputs=True,
+            quantize_workers=max(2, len(devices)),
+            quantize_devices=devices,
+            calibration_enable_gpu_cache=False,
+        )
+
+        print(f"sequential ppl: {sequential_ppl}, fp layer inputs ppl: {fp_inputs_ppl}")
+        # layers no longer compensate the quantization error of the layers before them
+        assert fp_inputs_ppl - sequential_ppl < 0.05 * sequential_ppl
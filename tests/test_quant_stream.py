@@ -0,0 +1,88 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import glob  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import FORMAT, QuantizeConfig  # noqa: E402
+from safetensors.torch import load_file  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestQuantStream(unittest.TestCase):
+    NATIVE_MODEL_ID = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(64))]
+
+        self.quantize_config = QuantizeConfig(
+            bits=4,
+            group_size=128,
+            format=FORMAT.GPTQ,
+        )
+
+    @staticmethod
+    def load_state_dict(path):
+        state_dict = {}
+        for file in glob.glob(os.path.join(path, "*.safetensors")):
+            state_dict.update(load_file(file))
+        return state_dict
+
+    def test_stream(self):
+        with tempfile.TemporaryDirectory() as stream_dir, tempfile.TemporaryDirectory() as reference_dir:
+            model = GPTQModel.from_pretrained(
+                self.NATIVE_MODEL_ID,
+                quantize_config=self.quantize_config,
+                stream_save_dir=stream_dir,
+                stream_max_shard_size="200MB",
+            )
+            # layers stay on the meta device until they are quantized
+            self.assertEqual(next(model.model.parameters()).device, torch.device("meta"))
+            model.pack(*model.quantize(self.calibration_dataset))
+
+            self.assertTrue(os.path.isfile(os.path.join(stream_dir, "model.safetensors.index.json")))
+            with self.assertRaises(ValueError):
+                model.save_quantized(stream_dir)
+
+            reference_model = GPTQModel.from_pretrained(
+                self.NATIVE_MODEL_ID,
+                quantize_config=self.quantize_config,
+            )
+            reference_model.pack(*reference_model.quantize(self.calibration_dataset))
+            reference_model.save_quantized(reference_dir)
+
+            state_dict = self.load_state_dict(stream_dir)
+            reference_state_dict = self.load_state_dict(reference_dir)
+            self.assertEqual(sorted(state_dict), sorted(reference_state_dict))
+            for name, tensor in reference_state_dict.items():
+                self.assertTrue(torch.equal(state_dict[name], tensor), name)
+
+            model = GPTQModel.from_quantized(stream_dir, device="cuda:0")
+            inp = self.tokenizer("The capital of France is", return_tensors="pt").to("cuda:0")
+            self.assertGreater(len(model.generate(**inp, max_new_tokens=8)[0]), inp["input_ids"].shape[1])
+
+    def test_pipeline(self):
+        with tempfile.TemporaryDirectory() as pipeline_dir, tempfile.TemporaryDirectory() as reference_dir:
+            model = GPTQModel.from_pretrained(self.NATIVE_MODEL_ID, quantize_config=self.quantize_config)
+            model.pack(*model.quantize(self.calibration_dataset, pipeline_save_dir=pipeline_dir, pipeline_max_shard_size="200MB"))
+            self.assertTrue(os.path.isfile(os.path.join(pipeline_dir, "model.safetensors.index.json")))
+
+            # the packed model stays in memory and saves the same tensors again
+            model.save_quantized(reference_dir)
+
+            state_dict = self.load_state_dict(pipeline_dir)
+            reference_state_dict = self.load_state_dict(reference_dir)
+            self.assertEqual(sorted(state_dict), sorted(reference_state_dict))
+            for name, tensor in reference_state_dict.items():
+                self.assertTrue(torch.equal(state_dict[name], tensor), name)
@@ -0,0 +1,63 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import FORMAT, QuantizeConfig  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestQuantSweep(unittest.TestCase):
+    NATIVE_MODEL_ID = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(64))]
+
+    @staticmethod
+    def quantize_config(**kwargs):
+        return QuantizeConfig(format=FORMAT.GPTQ, **kwargs)
+
+    def quantize(self, quantize_config, **kwargs):
+        model = GPTQModel.from_pretrained(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+        model.pack(*model.quantize(self.calibration_dataset, **kwargs))
+        return model
+
+    def assert_state_dict_equal(self, model, reference_model):
+        state_dict = model.model.state_dict()
+        reference_state_dict = reference_model.model.state_dict()
+        self.assertEqual(sorted(state_dict), sorted(reference_state_dict))
+        for name, tensor in reference_state_dict.items():
+            self.assertTrue(torch.equal(state_dict[name].cpu(), tensor.cpu()), name)
+
+    def test_sweep(self):
+        # a single subset per layer, so every module of quantize(fp_layer_inputs=True) sees full precision inputs
+        configs = [
+            self.quantize_config(bits=4, group_size=128, true_sequential=False),
+            self.quantize_config(bits=4, group_size=32, true_sequential=False),
+            self.quantize_config(bits=8, group_size=128),
+        ]
+
+        model = GPTQModel.from_pretrained(self.NATIVE_MODEL_ID, quantize_config=configs[0])
+        weight = next(model.model.parameters()).clone()
+        models = model.quantize_sweep(self.calibration_dataset, configs, quantized_inputs=[False, False, True])
+
+        self.assertEqual(len(models), len(configs))
+        self.assertTrue(all(m.quantized for m in models))
+        # the swept model keeps its full precision weights
+        self.assertFalse(model.quantized)
+        self.assertTrue(torch.equal(next(model.model.parameters()), weight))
+
+        for quantize_config, swept in zip(configs[:2], models[:2]):
+            self.assert_state_dict_equal(swept, self.quantize(quantize_config, fp_layer_inputs=True))
+        # quantized inputs follow the layers quantized before, as quantize() does
+        self.assert_state_dict_equal(models[2], self.quantize(configs[2]))
@@ -0,0 +1,54 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import json  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.utils.timer import StageTimer  # noqa: E402
+
+
+class TestStageTimer(unittest.TestCase):
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    def test_flush(self):
+        timer = StageTimer()
+        x = torch.randn(256, 256)
+
+        timer.add("forward", tokens=128)
+        with timer.stage("forward", self.DEVICE):
+            x.to(self.DEVICE).matmul(x.to(self.DEVICE))
+        # stages still account time when the body raises
+        with self.assertRaises(ValueError):
+            with timer.stage("capture", self.DEVICE):
+                raise ValueError
+        x = timer.move(x, torch.device("meta"))
+
+        stats = timer.flush(1)
+        self.assertEqual(stats["layer"], 1)
+        self.assertEqual(list(stats["stages"]), ["capture", "forward", "move"])
+        self.assertEqual(stats["stages"]["forward"]["tokens"], 128)
+        self.assertEqual(stats["stages"]["move"]["bytes"], 256 * 256 * 4)
+        self.assertEqual(x.device, torch.device("meta"))
+
+        # flush() resets
+        self.assertEqual(timer.flush(2), {"layer": 2, "stages": {}})
+
+    def test_emit(self):
+        entries = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "stats.jsonl")
+            timer = StageTimer(log_file=log_file, callback=entries.append)
+            for layer in range(3):
+                timer.add("quant", seconds=0.5)
+                timer.emit(timer.flush(layer))
+
+            with open(log_file) as f:
+                lines = [json.loads(line) for line in f]
+
+        self.assertEqual(lines, entries)
+        self.assertEqual([entry["layer"] for entry in lines], [0, 1, 2])
@@ -0,0 +1,91 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.models.base import StopForward  # noqa: E402
+from gptqmodel.models.llama import LlamaGPTQ  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.quantization.gptq import GPTQ  # noqa: E402
+from gptqmodel.utils.model import find_layers  # noqa: E402
+from transformers import LlamaConfig, LlamaForCausalLM  # noqa: E402
+from transformers.models.llama.modeling_llama import LlamaDecoderLayer  # noqa: E402
+
+
+class TestTruncateSubsetForward(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.config = LlamaConfig(
+            vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+            num_key_value_heads=4, pad_token_id=0,
+        )
+
+    def collect_hessians(self, layer, subset, batches, truncate):
+        """Capture the Hessians of the `subset` modules of `layer` the way quantize() does, returns them and the
+        names of all modules that ran."""
+        full = find_layers(layer)
+        gptq = {name: GPTQ(full[name]) for name in subset}
+        ran = set()
+        fired = set()
+
+        def add_batch(name):
+            def tmp(_, inp, out):
+                gptq[name].add_batch(inp[0].data, out.data)
+                if truncate:
+                    fired.add(name)
+                    if len(fired) == len(subset):
+                        raise StopForward
+
+            return tmp
+
+        handles = [full[name].register_forward_hook(add_batch(name)) for name in subset]
+        handles += [module.register_forward_pre_hook(lambda m, _, n=name: ran.add(n)) for name, module in full.items()]
+        for hidden_states, position_ids in batches:
+            fired.clear()
+            try:
+                layer(hidden_states, position_ids=position_ids)
+            except StopForward:
+                pass
+        for handle in handles:
+            handle.remove()
+        return {name: gptq[name].H for name in subset}, ran
+
+    def test_decoder_layer_hessians(self):
+        layer = LlamaDecoderLayer(self.config, layer_idx=0).eval()
+        batches = [(torch.randn(2, n, 64), torch.arange(n)[None]) for n in (5, 9)]
+
+        with torch.no_grad():
+            for subset in LlamaGPTQ.layer_modules:
+                expected, ran_full = self.collect_hessians(layer, subset, batches, truncate=False)
+                hessians, ran = self.collect_hessians(layer, subset, batches, truncate=True)
+                for name in subset:
+                    self.assertTrue(torch.equal(hessians[name], expected[name]), name)
+                # the modules after the subset are skipped
+                self.assertEqual(ran < ran_full, subset != LlamaGPTQ.layer_modules[-1], subset)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs a cuda device")
+    def test_quantize(self):
+        calibration_dataset = [
+            {"input_ids": ids.tolist(), "attention_mask": [1] * len(ids)}
+            for ids in (torch.randint(1, 256, (n,)) for n in (24, 40, 17, 33))
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            LlamaForCausalLM(self.config).save_pretrained(tmp_dir)
+
+            state_dicts = []
+            for truncate in (False, True):
+                model = GPTQModel.from_pretrained(tmp_dir, QuantizeConfig(bits=4, group_size=32))
+                model.pack(*model.quantize(calibration_dataset, truncate_subset_forward=truncate))
+                state_dicts.append(model.model.state_dict())
+
+        expected, state_dict = state_dicts
+        self.assertEqual(sorted(state_dict), sorted(expected))
+        for name, tensor in expected.items():
+            self.assertTrue(torch.equal(state_dict[name].cpu(), tensor.cpu()), name)
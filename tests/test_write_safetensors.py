@@ -0,0 +1,98 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.utils.stream import ShardWriter, StagingBuffer, write_safetensors  # noqa: E402
+from safetensors import safe_open  # noqa: E402
+from safetensors.torch import load_file  # noqa: E402
+
+
+class TestWriteSafetensors(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tensors = {
+            "weight": torch.randn(8, 6, dtype=torch.bfloat16),
+            # a transposed view is written in its logical layout
+            "transposed": torch.randn(6, 8).t(),
+            "qweight": torch.randint(-2**31, 2**31 - 1, (3, 5), dtype=torch.int32),
+            "mask": torch.rand(7) > 0.5,
+            "scalar": torch.tensor(3, dtype=torch.int8),
+            "empty": torch.zeros(0, 4, dtype=torch.float16),
+        }
+
+    def assert_saved(self, file, tensors):
+        loaded = load_file(file)
+        self.assertEqual(sorted(loaded), sorted(tensors))
+        for name, tensor in tensors.items():
+            self.assertEqual(loaded[name].dtype, tensor.dtype, name)
+            self.assertTrue(torch.equal(loaded[name], tensor.cpu()), name)
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file = os.path.join(tmp_dir, "model.safetensors")
+            write_safetensors(file, self.tensors, {"format": "pt"})
+            self.assert_saved(file, self.tensors)
+            with safe_open(file, framework="pt") as f:
+                self.assertEqual(f.metadata(), {"format": "pt"})
+            self.assertEqual(os.listdir(tmp_dir), ["model.safetensors"])
+
+    def test_write_transform(self):
+        def transform(name, tensor):
+            return tensor - 1 if name == "qweight" else tensor
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file = os.path.join(tmp_dir, "model.safetensors")
+            write_safetensors(file, self.tensors, transform=transform)
+            self.assert_saved(file, {**self.tensors, "qweight": self.tensors["qweight"] - 1})
+
+            with self.assertRaises(ValueError):
+                write_safetensors(file, self.tensors, transform=lambda name, tensor: tensor.float())
+
+    def test_shard_writer_overwrite(self):
+        tensors = {f"layers.{n}.weight": torch.randn(16, 16) for n in range(4)}
+
+        def write(save_dir, max_shard_size):
+            writer = ShardWriter(save_dir, max_shard_size=max_shard_size)
+            for name, tensor in tensors.items():
+                writer.add({name: tensor})
+            writer.finish()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a previous save with more shards, an interrupted one and files of other models are left behind
+            write(tmp_dir, 1024)
+            for filename in ["model-00003.safetensors.tmp", "model.safetensors", "other-00001-of-00002.safetensors",
+                             "config.json"]:
+                open(os.path.join(tmp_dir, filename), "w").close()
+
+            write(tmp_dir, 2048)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), [
+                "config.json",
+                "model-00001-of-00002.safetensors",
+                "model-00002-of-00002.safetensors",
+                "model.safetensors.index.json",
+                "other-00001-of-00002.safetensors",
+            ])
+
+            write(tmp_dir, None)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), [
+                "config.json", "model.safetensors", "other-00001-of-00002.safetensors",
+            ])
+            self.assert_saved(os.path.join(tmp_dir, "model.safetensors"), tensors)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs a cuda device")
+    def test_write_cuda(self):
+        tensors = {name: tensor.to("cuda:0") for name, tensor in self.tensors.items()}
+        tensors["large"] = torch.randn(1000, device="cuda:0")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file = os.path.join(tmp_dir, "model.safetensors")
+            # several chunks per tensor, alternating between both pinned buffers
+            write_safetensors(file, tensors, {"format": "pt"}, StagingBuffer(chunk_size=256))
+            self.assert_saved(file, tensors)
+        # nothing was moved off the device
+        self.assertTrue(all(tensor.device.type == "cuda" for tensor in tensors.values()))